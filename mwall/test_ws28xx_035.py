@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Tests for the ws28xx-035 driver.  These need weewx and pyusb to import
+# the driver, but not a transceiver.  Run them from the weewx root dir:
+#
+# PYTHONPATH=bin python -m unittest discover -s mwall -p 'test_*.py'
+
+import imp
+import os
+import unittest
+
+ws = imp.load_source('ws28xx_035', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'ws28xx-035.py'))
+
+# current weather frame from the 'Examples of messages' section of the driver
+SAMPLE_CURRENT_FRAME = [int(x, 16) for x in """
+    01 2e 60 5f 05 1b 00 00 12 01 30 62 21 54 41 30 62 40 75 36
+    59 00 60 70 06 35 00 01 30 62 31 61 21 30 62 30 55 95 92 00
+    53 10 05 37 00 01 30 62 01 90 81 30 62 40 90 66 38 00 49 00
+    05 37 00 01 30 62 21 53 01 30 62 22 31 75 51 11 50 40 05 13
+    80 13 06 22 21 40 13 06 23 19 37 67 52 59 13 06 23 06 09 13
+    06 23 16 19 91 65 86 00 00 00 00 00 00 00 00 00 00 00 00 00
+    00 00 00 00 00 00 00 00 00 13 06 23 09 59 00 06 19 00 00 51
+    13 06 22 20 43 00 01 54 00 00 00 01 30 62 21 51 00 00 38 70
+    a7 cc 7b 50 09 01 01 00 00 00 00 00 00 fc 00 a7 cc 7b 14 13
+    06 23 14 06 0e a0 00 01 b0 00 13 06 23 06 34 03 00 91 01 92
+    03 00 91 01 92 02 97 41 00 74 03 00 91 01 92""".split()]
+SAMPLE_CURRENT_FRAME += [0] * (0x131 - len(SAMPLE_CURRENT_FRAME))
+
+# steps of the system clock, as ntp makes them on a computer without a
+# real-time clock
+CLOCK_STEPS = [3600, -3600, -86400, 366 * 86400, -366 * 86400]
+
+
+class ClockStepTest(unittest.TestCase):
+    """Steps of the system clock must not change the communication timing.
+    Only the timestamps of the observations follow the system clock."""
+
+    def setUp(self):
+        self.saved_clock = ws.clock
+        ws.clock = ws.SteppedClock()
+        self.svc = ws.CommunicationService(0.3)
+        self.svc.command = ws.ACTION_GET_HISTORY
+        self.svc.comm_mode_interval = 8
+        self.handle_current()
+
+    def tearDown(self):
+        ws.clock = self.saved_clock
+
+    def handle_current(self):
+        """Hand a current weather frame to the service.  Return True if
+        the service kept it, False if it skipped it."""
+        n = self.svc.rf_stats['weather_frames']
+        self.svc.handleCurrentData([list(SAMPLE_CURRENT_FRAME)],
+                                   [len(SAMPLE_CURRENT_FRAME)])
+        return self.svc.rf_stats['weather_frames'] != n
+
+    def test_age(self):
+        for step in CLOCK_STEPS:
+            ws.clock.step(step)
+            self.assertTrue(self.svc.last_stat.age('weather') < 1,
+                            'step %+d s' % step)
+
+    def test_no_morph(self):
+        """The request for history is not replaced by a request for current
+        weather, as it would be if the weather data looked old."""
+        for step in CLOCK_STEPS:
+            ws.clock.step(step)
+            buf = [list(SAMPLE_CURRENT_FRAME)]
+            self.svc.buildACKFrame(buf, ws.ACTION_GET_HISTORY, 0)
+            self.assertEqual(buf[0][2], ws.ACTION_GET_HISTORY,
+                             'step %+d s' % step)
+
+    def test_no_skip(self):
+        """A frame within comm_mode_interval of the previous one is still
+        skipped, whichever way the clock was stepped."""
+        for step in CLOCK_STEPS:
+            ws.clock.step(step)
+            self.assertFalse(self.handle_current(), 'step %+d s' % step)
+
+    def test_timestamp(self):
+        ws.clock.step(86400)
+        self.svc.comm_mode_interval = 0
+        self.assertTrue(self.handle_current())
+        self.assertTrue(
+            abs(self.svc.current._timestamp - ws.clock.time()) < 2)
+
+
+class MonotonicTest(unittest.TestCase):
+
+    def test_monotonic(self):
+        c = ws.Clock()
+        t = [c.monotonic() for _ in range(1000)]
+        self.assertEqual(t, sorted(t))
+
+
+if __name__ == '__main__':
+    unittest.main()
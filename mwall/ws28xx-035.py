@@ -925,7 +925,23 @@ Step 8. Go to step 1 to wait for state 0xde16 again.
 #        interval should clear the history.
 
 from datetime import datetime
+import array
+import collections
+import cPickle
+import ctypes
+import ctypes.util
+import json
+import marshal
+import math
+import mmap
+import multiprocessing
+import os
 import random
+import select
+import signal
+import socket
+import stat
+import struct
 
 import StringIO
 import sys
@@ -936,7 +952,6 @@ import traceback
 import usb
 
 import weewx.drivers
-import weewx.wxformulas
 import weeutil.weeutil
 
 DRIVER_NAME = 'WS28xx'
@@ -1066,6 +1081,64 @@ def print_dict(data):
             print '%s: %s' % (x, data[x])
 
 
+def _get_monotonic():
+    """Return a function that reads CLOCK_MONOTONIC, or time.time if that
+    is not available on this system.  The number of CLOCK_MONOTONIC is
+    different on other systems, so this is done only on linux.  Elsewhere
+    ages and intervals follow the system clock, as they did before."""
+    if not sys.platform.startswith('linux'):
+        return time.time
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+    CLOCK_MONOTONIC = 1  # from linux/time.h
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+class Clock(object):
+    """Source of time for the driver.  Use time() for timestamps, which
+    are wall-clock time.  Use monotonic() for ages, intervals and
+    deadlines, so that they are not upset when the system clock is set,
+    for example by ntp on a computer without a real-time clock."""
+
+    def __init__(self):
+        self._monotonic = _get_monotonic()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return self._monotonic()
+
+
+class SteppedClock(Clock):
+    """Clock whose wall-clock time can be stepped, as ntp does, for
+    testing.  The monotonic time is not affected by steps."""
+
+    def __init__(self):
+        super(SteppedClock, self).__init__()
+        self.offset = 0
+
+    def step(self, seconds):
+        self.offset += seconds
+
+    def time(self):
+        return time.time() + self.offset
+
+
+clock = Clock()
+
+
 class WS28xxConfEditor(weewx.drivers.AbstractConfEditor):
     @property
     def default_stanza(self):
@@ -1106,17 +1179,28 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
                           help="set logging interval to N minutes")
         parser.add_option("--current", dest="current", action="store_true",
                           help="get the current weather conditions")
+        parser.add_option("--frame-rate", dest="frame_rate", type=int,
+                          metavar="N",
+                          help="count current weather frames for N seconds")
         parser.add_option("--history", dest="nrecords", type=int, metavar="N",
                           help="display N history records")
         parser.add_option("--history-since", dest="recmin",
                           type=int, metavar="N",
                           help="display history records since N minutes ago")
+        parser.add_option("--export", dest="export", metavar="FILE",
+                          help="append new history records to FILE")
+        parser.add_option("--export-format", dest="export_format",
+                          type="choice", choices=['csv', 'binary'],
+                          help="format for --export, either csv or binary")
+        parser.add_option("--profile", dest="profile", type=float,
+                          metavar="N",
+                          help="profile the running driver for N seconds")
         parser.add_option("--maxtries", dest="maxtries", type=int,
                           help="maximum number of retries, 0 indicates no max")
 
     def do_options(self, options, parser, config_dict, prompt):
         maxtries = 3 if options.maxtries is None else int(options.maxtries)
-        self.station = WS28xxDriver(**config_dict[DRIVER_NAME])
+        self.station = self.get_station(config_dict[DRIVER_NAME])
         if options.check:
             self.check_transceiver(maxtries)
         elif options.pair:
@@ -1125,6 +1209,17 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
             self.set_interval(maxtries, options.interval, prompt)
         elif options.current:
             self.show_current(maxtries)
+        elif options.frame_rate is not None:
+            self.show_frame_rate(options.frame_rate)
+        elif options.profile is not None:
+            self.start_profile(options.profile)
+        elif options.export is not None:
+            ts = None
+            if options.recmin is not None:
+                ts = int(time.time()) - options.recmin * 60
+            self.export_history(maxtries, options.export,
+                                fmt=options.export_format, ts=ts,
+                                count=options.nrecords or 0)
         elif options.nrecords is not None:
             self.show_history(maxtries, count=options.nrecords)
         elif options.recmin is not None:
@@ -1134,6 +1229,42 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
             self.show_info(maxtries)
         self.station.closePort()
 
+    @staticmethod
+    def get_station(stn_dict):
+        """Use the control socket of a running driver if there is one,
+        otherwise open the transceiver."""
+        path = stn_dict.get('control_socket')
+        if path is not None:
+            client = ControlClient(path)
+            if client.ping():
+                print 'Using running driver at %s' % path
+                return client
+        return WS28xxDriver(**stn_dict)
+
+    def start_profile(self, duration):
+        """Profile the running driver."""
+        if not isinstance(self.station, ControlClient):
+            print 'Profiling requires a running driver with a control_socket'
+            return
+        try:
+            paths = self.station.start_profile(duration)
+        except weewx.WeeWxIOError, e:
+            print 'Cannot profile: %s' % e
+            return
+        print 'Profiling for %s seconds, writing to:' % duration
+        for path in paths:
+            print '  %s' % path
+
+    def show_frame_rate(self, duration):
+        """Measure how many current weather frames per minute arrive."""
+        print 'Counting current weather frames for %d seconds...' % duration
+        start = clock.monotonic()
+        n0 = self.station.get_link_stats()['rf'].get('weather_frames', 0)
+        time.sleep(duration)
+        n = self.station.get_link_stats()['rf'].get('weather_frames', 0) - n0
+        print 'current weather frames per minute: %.1f' % (
+            60.0 * n / (clock.monotonic() - start))
+
     def check_transceiver(self, maxtries):
         """See if the transceiver is installed and operational."""
         print 'Checking for transceiver...'
@@ -1148,7 +1279,8 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
                 print 'id: %d (0x%04x)' % (tid, tid)
                 break
             print 'Not found (attempt %d of %d) ...' % (ntries, maxtries)
-            time.sleep(5)
+            self.station.wait_for_change(self.station.transceiver_is_present,
+                                         5)
         else:
             print 'Transceiver not responding.'
 
@@ -1168,11 +1300,8 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
             else:
                 msg += ' (attempt %d)' % ntries
             print msg
-            now = start_ts = int(time.time())
-            while (now - start_ts < maxwait and
-                   not self.station.transceiver_is_paired()):
-                time.sleep(5)
-                now = int(time.time())
+            self.station.wait_for_change(self.station.transceiver_is_paired,
+                                         maxwait)
         else:
             print 'Transceiver not paired to console.'
 
@@ -1183,19 +1312,15 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
         return getHistoryInterval(cfg['history_interval'])
 
     def get_config(self, maxtries):
-        start_ts = None
+        start_ts = int(time.time())
         ntries = 0
         while ntries < maxtries or maxtries == 0:
-            cfg = self.station.get_config()
-            if cfg is not None:
-                return cfg
+            if self.station.wait_for_change(
+                lambda: self.station.get_config() is not None, 30):
+                return self.station.get_config()
             ntries += 1
-            if start_ts is None:
-                start_ts = int(time.time())
-            else:
-                dur = int(time.time()) - start_ts
-                print 'No data after %d seconds (press SET to sync)' % dur
-            time.sleep(30)
+            dur = int(time.time()) - start_ts
+            print 'No data after %d seconds (press SET to sync)' % dur
         return None
 
     def set_interval(self, maxtries, interval, prompt):
@@ -1212,25 +1337,47 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
     def show_current(self, maxtries):
         """Get current weather observation."""
         print 'Querying the station for current weather data...'
-        start_ts = None
+        start_ts = int(time.time())
         ntries = 0
         while ntries < maxtries or maxtries == 0:
-            packet = self.station.get_observation()
-            if packet is not None:
-                print_dict(packet)
+            if self.station.wait_for_change(
+                lambda: self.station.get_observation() is not None, 30):
+                print_dict(self.station.get_observation())
                 break
             ntries += 1
-            if start_ts is None:
-                start_ts = int(time.time())
-            else:
-                dur = int(time.time()) - start_ts
-                print 'No data after %d seconds (press SET to sync)' % dur
-            time.sleep(30)
+            dur = int(time.time()) - start_ts
+            print 'No data after %d seconds (press SET to sync)' % dur
 
     def show_history(self, maxtries, ts=0, count=0):
         """Display the indicated number of records or the records since the 
         specified timestamp (local time, in seconds)"""
         print "Querying the station for historical records..."
+        records = self.get_history(maxtries, ts=ts, count=count)
+        print 'Found %d records' % len(records)
+        for r in records:
+            print r
+
+    def export_history(self, maxtries, filename, fmt=None, ts=None, count=0):
+        """Append history records to a file.  If no timestamp or count is
+        specified, get only the records newer than those already in the
+        file."""
+        exporter = get_history_exporter(filename, fmt)
+        try:
+            exporter.check()
+        except ValueError, e:
+            print 'Cannot export to %s: %s' % (filename, e)
+            return
+        last_ts = exporter.get_last_timestamp()
+        if ts is None and not count:
+            ts = 0 if last_ts is None else last_ts + 1
+        print "Querying the station for historical records..."
+        records = self.get_history(maxtries, ts=ts, count=count)
+        n = exporter.append(records)
+        print 'Exported %d of %d records to %s' % (n, len(records), filename)
+
+    def get_history(self, maxtries, ts=0, count=0):
+        if isinstance(self.station, ControlClient):
+            return self.get_remote_history(maxtries, ts=ts, count=count)
         ntries = 0
         last_n = nrem = None
         last_ts = int(time.time())
@@ -1239,7 +1386,11 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
             if ntries >= maxtries:
                 print 'Giving up after %d tries' % ntries
                 break
-            time.sleep(30)
+            # wait until more records are scanned or none remain
+            self.station.wait_for_change(
+                lambda: (self.station.get_num_history_scanned() != last_n or
+                         self.station.get_uncached_history_count() == 0),
+                30)
             ntries += 1
             now = int(time.time())
             n = self.station.get_num_history_scanned()
@@ -1260,9 +1411,33 @@ class WS28xxConfigurator(weewx.drivers.AbstractConfigurator):
         records = self.station.get_history_cache_records()
         self.station.clear_history_cache()
         print
-        print 'Found %d records' % len(records)
-        for r in records:
-            print r
+        proc = HistoryProcessor(self.station.get_history_interval())
+        return list(proc.process(records))
+
+    def get_remote_history(self, maxtries, ts=0, count=0):
+        """Run a history download job in the running driver."""
+        reply = self.station.start_history_job(since_ts=ts, count=count)
+        if 'error' in reply:
+            print 'Cannot start history download: %s' % reply['error']
+            return []
+        job_id = reply['job']
+        while True:
+            time.sleep(2)
+            job = self.station.get_history_job(job_id)
+            if 'error' in job:
+                print
+                print 'History download failed: %s' % job['error']
+                return []
+            msg = "  scanned %s records: current=%s latest=%s remaining=%s\r" % (
+                job['scanned'], job['current'], job['latest'], job['remaining'])
+            sys.stdout.write(msg)
+            sys.stdout.flush()
+            if job['state'] != 'running':
+                break
+        print
+        if job['state'] != 'done':
+            print 'History download %s' % job['state']
+        return job['records'] or []
 
 
 class WS28xxDriver(weewx.drivers.AbstractDevice):
@@ -1286,6 +1461,69 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
         comm_interval: Communications mode interval
         [Optional.  Default is 8]
 
+        adaptive_comm_interval: Use comm_interval_active while it rains or
+        the wind is strong or gusty, and comm_interval_calm otherwise,
+        instead of comm_interval.  See CommIntervalController.
+        [Optional. Default is False]
+
+        comm_interval_active: Communications mode interval during rain or
+        wind.
+        [Optional. Default is 4]
+
+        comm_interval_calm: Communications mode interval during calm
+        weather.
+        [Optional. Default is 16]
+
+        active_gust: Gust speed, in km/h, at or above which the weather is
+        considered active.
+        [Optional. Default is 30]
+
+        active_gust_change: Change in gust speed between weather frames, in
+        km/h, at or above which the weather is considered active.
+        [Optional. Default is 15]
+
+        calm_hold: How long, in seconds, the weather must be calm before
+        the calm interval is used again.
+        [Optional. Default is 900]
+
+        recovery_packets: Number of consecutive empty packets after which
+        the driver tries to recover communication.  The driver first puts
+        the transceiver back into receive mode, then resets the
+        transceiver, then reopens the USB device, each after another
+        recovery_packets empty packets.  If that does not help, the driver
+        starts again with the first step, or raises an error so that weewx
+        restarts it if recovery_restart is True.
+        [Optional. Default is 6]
+
+        recovery_restart: Whether to raise an error so that weewx restarts
+        the driver when none of the recovery steps helped.
+        [Optional. Default is False]
+
+        fast_current_weather: Ask the console for current weather in every
+        communication cycle and return every weather frame as a LOOP packet,
+        instead of sampling the current weather every polling_interval.
+        [Optional. Default is False]
+
+        derived_observations: Where dewpoint, windchill and barometer come
+        from, either hardware or software.  With hardware, the driver
+        reports the dewpoint and windchill calculated by the console, and
+        the relative pressure of the console as barometer, so that weewx
+        need not calculate them for every LOOP packet.  With software,
+        the driver does not report them, and weewx calculates them.
+        Note that the console reports only the relative pressure, which
+        it has already corrected to sea level using the offset set on the
+        console.  The driver reports that same value as pressure in both
+        modes, so with hardware pressure and barometer are equal, and with
+        software weewx corrects an already corrected pressure unless the
+        altitude in weewx.conf is 0.
+        [Optional. Default is software]
+
+        wind_average_samples: Number of recent wind directions in the
+        vector average that is reported as windDirAvg.  The console
+        reports the current direction and the 5 before it, so use at
+        least 6.
+        [Optional. Default is 6]
+
         device_id: The USB device ID for the transceiver.  If there are
         multiple devices with the same vendor and product IDs on the bus,
         each will have a unique device identifier.  Use this identifier
@@ -1297,11 +1535,131 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
         have a unique serial number.  Use the serial number to indicate which
         transceiver should be used.
         [Optional. Default is None]
+
+        flash_cache_file: File in which to save the frequency correction
+        and identifier read from the transceiver flash, by serial number,
+        so that they need not be read each time the driver starts.
+        [Optional. Default is None]
+
+        usb_retries: How many times to retry a USB operation that timed out
+        or stalled, waiting a little longer before each retry.
+        [Optional. Default is 3]
+
+        usb_reconnect_timeout: How long to wait, in seconds, for the
+        transceiver to show up on the bus again after it went away.
+        [Optional. Default is 60]
+
+        frame_ring_size: Number of recent frames to keep in memory, with
+        their times and how they were handled, for diagnosing problems.
+        [Optional. Default is 64]
+
+        frame_dump_dir: Directory in which to write the recent frames when
+        the console sends a bad response or an unknown device ID, on a USB
+        error, when recovery starts after too many empty packets, or before
+        the driver restarts.  At most one file is written every 5 minutes,
+        and only the newest 10 files are kept.  Use None to disable.
+        [Optional. Default is /var/tmp]
+
+        profile_signal: Signal that makes the driver sample the call stacks
+        of the RF thread and the driver thread for profile_duration seconds
+        then write where they spent their time to profile_dir.  Profiling
+        can also be started with 'wee_config --profile' when there is a
+        control_socket.  Use None to ignore signals.
+        [Optional. Default is SIGUSR2]
+
+        profile_duration: How long to profile, in seconds.
+        [Optional. Default is 60]
+
+        profile_interval: Time between samples while profiling, in seconds.
+        [Optional. Default is 0.05]
+
+        profile_format: Either collapsed, for collapsed stacks as used by
+        flame graph tools, or pstats, for a file that can be loaded with
+        the python pstats module.
+        [Optional. Default is collapsed]
+
+        profile_dir: Directory in which to write profiles.
+        [Optional. Default is /var/tmp]
+
+        rain_state_file: File in which to save the rain counter of the
+        last history record, so that rain in history records can be
+        calculated across restarts.
+        [Optional. Default is None]
+
+        control_socket: Path of a Unix-domain socket on which the driver
+        answers queries from wee_config about the current observation,
+        station configuration, link status and history, so that the
+        configurator does not have to open the transceiver.
+        [Optional. Default is None]
+
+        backfill_wait: How long, in seconds, to wait for historical records
+        at startup before LOOP packets are generated.  Records that arrive
+        later are returned by genArchiveRecords, so this is useful only
+        with hardware record generation.  With software record generation
+        they are discarded.  If not specified, wait until all
+        historical records have been read.
+        [Optional. Default is None]
+
+        hardware_record_generation: Read each new record from the station
+        history as soon as the console stores it, and return it from
+        genArchiveRecords.  Use this with record_generation = hardware.
+        Only then does the driver report the history interval of the
+        console as the archive interval.
+        [Optional. Default is False]
+
+        rf_process: Run the RF communication in a separate process instead
+        of a thread, so that it is not delayed by other weewx activity such
+        as report generation.
+        [Optional. Default is False]
+
+        rf_priority: SCHED_FIFO priority of the RF process.  This requires
+        the appropriate privileges.
+        [Optional. Default is None]
+
+        rf_cpus: Comma-separated list of cpus on which the RF process runs.
+        [Optional. Default is None]
+
+        shm_file: File to which the driver publishes each new observation
+        and the link status, for other processes on the same computer.
+        See ObservationPublisher for the layout.
+        [Optional. Default is None]
+
+        multicast_address: Multicast group and port, as group:port, to which
+        the driver sends each new observation.  See MulticastPublisher.
+        [Optional. Default is None]
+
+        multicast_format: Format of the multicast datagrams, either json
+        or binary.
+        [Optional. Default is json]
+
+        multicast_ttl: Time-to-live of the multicast datagrams.  Use 0 to
+        keep them on this computer, 1 to keep them on the local network.
+        [Optional. Default is 1]
         """
 
         self.model            = stn_dict.get('model', 'LaCrosse WS28xx')
         self.polling_interval = int(stn_dict.get('polling_interval', 10))
         self.comm_interval    = int(stn_dict.get('comm_interval', 8))
+        self.fast_current_weather = weeutil.weeutil.tobool(
+            stn_dict.get('fast_current_weather', False))
+        self.derived_observations = stn_dict.get('derived_observations',
+                                                 'software')
+        if self.derived_observations not in ['hardware', 'software']:
+            raise ValueError("unknown derived_observations '%s'" %
+                             self.derived_observations)
+        self._packet_builder = PacketBuilder(
+            self.derived_observations == 'hardware')
+        self._wind_average = WindVectorAverage(
+            int(stn_dict.get('wind_average_samples', 6)))
+        self.comm_controller = None
+        if weeutil.weeutil.tobool(stn_dict.get('adaptive_comm_interval',
+                                               False)):
+            self.comm_controller = CommIntervalController(
+                int(stn_dict.get('comm_interval_active', 4)),
+                int(stn_dict.get('comm_interval_calm', 16)),
+                gust=float(stn_dict.get('active_gust', 30.0)),
+                gust_change=float(stn_dict.get('active_gust_change', 15.0)),
+                hold=int(stn_dict.get('calm_hold', 900)))
         self.frequency        = stn_dict.get('transceiver_frequency', 'US')
         self.device_id        = stn_dict.get('device_id', None)
         self.config_serial    = stn_dict.get('serial', None)
@@ -1309,17 +1667,81 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
         self.vendor_id        = 0x6666
         self.product_id       = 0x5555
 
-        now = int(time.time())
         self._service = None
-        self._last_rain = None
+        self._rain_counter = RainCounter(LOOP_RAIN_MAX)
+        self.rain_state_file = stn_dict.get('rain_state_file', None)
+        self.flash_cache_file = stn_dict.get('flash_cache_file', None)
+        self.usb_retries = int(stn_dict.get('usb_retries', 3))
+        self.usb_reconnect_timeout = int(
+            stn_dict.get('usb_reconnect_timeout', 60))
+        self.frame_ring_size = int(stn_dict.get('frame_ring_size', 64))
+        self.frame_dump_dir = stn_dict.get('frame_dump_dir', '/var/tmp')
+        if self.frame_dump_dir in ['', 'None', 'none']:
+            self.frame_dump_dir = None
+        self.profile_signal = stn_dict.get('profile_signal', 'SIGUSR2')
+        if self.profile_signal in ['', 'None', 'none']:
+            self.profile_signal = None
+        self.profile_duration = float(stn_dict.get('profile_duration', 60))
+        self.profile_interval = float(stn_dict.get('profile_interval', 0.05))
+        self.profile_format = stn_dict.get('profile_format', 'collapsed')
+        if self.profile_format not in SamplingProfiler.formats:
+            raise ValueError('unknown profile_format %s' %
+                             self.profile_format)
+        self.profile_dir = stn_dict.get('profile_dir', '/var/tmp')
+        self._profiler = None
+        self._profile_lock = threading.Lock()
+        self._profile_handler = None
+        self._driver_thread = threading.currentThread().getName()
+        self.control_socket = stn_dict.get('control_socket', None)
+        self.rf_process = weeutil.weeutil.tobool(
+            stn_dict.get('rf_process', False))
+        self.rf_priority = stn_dict.get('rf_priority', None)
+        if self.rf_priority is not None:
+            self.rf_priority = int(self.rf_priority)
+        self.rf_cpus = stn_dict.get('rf_cpus', None)
+        if self.rf_cpus is not None:
+            if not isinstance(self.rf_cpus, list):
+                self.rf_cpus = self.rf_cpus.split(',')
+            self.rf_cpus = [int(x) for x in self.rf_cpus]
+        self._control = None
+        self._last_packet = None
+        self.shm_file = stn_dict.get('shm_file', None)
+        self._publisher = None
+        self.multicast_address = stn_dict.get('multicast_address', None)
+        self.multicast_format = stn_dict.get('multicast_format', 'json')
+        self.multicast_ttl = int(stn_dict.get('multicast_ttl', 1))
+        self._multicast = None
+        self._history_lock = threading.Lock()
+        self.backfill_wait = stn_dict.get('backfill_wait', None)
+        if self.backfill_wait is not None:
+            self.backfill_wait = int(self.backfill_wait)
+        self.backfill_poll = 5  # how often to check for history records
+        self.history_timeout = 3900  # give up on history without progress
+        self._backfill = None
+        self._backfill_records = []
+        self.hardware_record_generation = weeutil.weeutil.tobool(
+            stn_dict.get('hardware_record_generation', False))
+        self._archive_index = None  # latest history index already read
+        self._archive_last_ts = None  # timestamp of the last record read
+        self._archive_target = None
         self._last_obs_ts = None
-        self._last_nodata_log_ts = now
+        self._last_obs_mono = None  # monotonic time of the last new data
+        self._last_nodata_log_ts = clock.monotonic()
         self._nodata_interval = 300  # how often to check for no data
-        self._last_contact_log_ts = now
+        self._last_contact_log_ts = clock.monotonic()
         self._nocontact_interval = 300  # how often to check for no contact
         self._log_interval = 600  # how often to log
         self._packet_count = 0
         self._empty_packet_count = 0
+        self._frame_rate_ts = clock.monotonic()
+        self._frame_rate_count = None
+        self._frame_rate = None  # measured weather frames per minute
+        self.recovery_packets = int(stn_dict.get('recovery_packets', 6))
+        self.recovery_restart = weeutil.weeutil.tobool(
+            stn_dict.get('recovery_restart', False))
+        self._recovery_tier = None
+        self._recovery_ts = None
+        self._recovery_stats = dict()
 
         global DEBUG_COMM
         DEBUG_COMM = int(stn_dict.get('debug_comm', 1))
@@ -1345,15 +1767,29 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
     def hardware_name(self):
         return self.model
 
+    @property
+    def archive_interval(self):
+        # only the records read from the console have the console interval.
+        # with software record generation the interval in weewx.conf rules.
+        if not self.hardware_record_generation:
+            raise NotImplementedError('archive_interval is set in weewx.conf')
+        interval = self.get_history_interval()
+        if interval is None:
+            raise NotImplementedError('history interval is not yet known')
+        return interval * 60
+
     # this is invoked by StdEngine as it shuts down
     def closePort(self):
         self.shutDown()
 
     def genLoopPackets(self):
         """Generator function that continuously returns decoded packets."""
+        self._driver_thread = threading.currentThread().getName()
         while True:
             self._packet_count += 1
-            now = int(time.time() + 0.5)
+            now = int(clock.time() + 0.5)
+            mono = clock.monotonic()
+            self.update_backfill()
             packet = self.get_observation()
             if packet is not None:
                 ts = packet['dateTime']
@@ -1362,9 +1798,18 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
                            (self._packet_count, ts, packet))
                 if self._last_obs_ts is None or self._last_obs_ts != ts:
                     self._last_obs_ts = ts
+                    self._last_obs_mono = mono
+                    self._last_packet = packet
+                    if self._publisher is not None:
+                        self._publisher.publish(
+                            packet, self._service.getLastStat())
+                    if self._multicast is not None:
+                        self._multicast.publish(packet)
                     self._empty_packet_count = 0
-                    self._last_nodata_log_ts = now
-                    self._last_contact_log_ts = now
+                    self._last_nodata_log_ts = mono
+                    self._last_contact_log_ts = mono
+                    if self._recovery_tier is not None:
+                        self.recovery_succeeded(mono)
                 else:
                     self._empty_packet_count += 1
                     if DEBUG_WEATHER_DATA > 0 and self._empty_packet_count > 1:
@@ -1380,90 +1825,319 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
                 if DEBUG_WEATHER_DATA > 0:
                     logdbg("packet_count=%s empty_count=%s" %
                            (self._packet_count, self._empty_packet_count))
-                if self._empty_packet_count >= 30:  # 30 * 10 s = 300 s
-                    if DEBUG_WEATHER_DATA > 0:
-                        msg = "Restarting communication after %d empty packets" % self._empty_packet_count
-                        logdbg(msg)
-                        raise weewx.WeeWxIOError('%s; press [USB] to sync' % msg)
+                self.check_recovery()
                 packet = {'usUnits': weewx.METRIC, 'dateTime': now}
                 # if no new weather data for awhile, log it
-                if self._last_obs_ts is None or \
-                        now - self._last_obs_ts > self._nodata_interval:
-                    if now - self._last_nodata_log_ts > self._log_interval:
+                if self._last_obs_mono is None or \
+                        mono - self._last_obs_mono > self._nodata_interval:
+                    if mono - self._last_nodata_log_ts > self._log_interval:
                         msg = 'no new weather data'
-                        if self._last_obs_ts is not None:
+                        if self._last_obs_mono is not None:
                             msg += ' after %d seconds' % (
-                                now - self._last_obs_ts)
+                                mono - self._last_obs_mono)
                         loginf(msg)
-                        self._last_nodata_log_ts = now
+                        self._last_nodata_log_ts = mono
 
             # if no contact with console for awhile, log it
-            ts = self.get_last_contact()
-            if ts is None or now - ts > self._nocontact_interval:
-                if now - self._last_contact_log_ts > self._log_interval:
+            age = self._service.getLastStat().age('seen')
+            if age is None or age > self._nocontact_interval:
+                if mono - self._last_contact_log_ts > self._log_interval:
                     msg = 'no contact with console'
-                    if ts is not None:
-                        msg += ' after %d seconds' % (now - ts)
+                    if age is not None:
+                        msg += ' after %d seconds' % age
                     msg += ': press [SET] to sync'
                     loginf(msg)
-                    self._last_contact_log_ts = now
+                    self._last_contact_log_ts = mono
 
             yield packet
-            time.sleep(self.polling_interval)                    
+            if self.fast_current_weather:
+                self.log_frame_rate(mono)
+                self._service.waitForCurrentData(self.polling_interval)
+            else:
+                time.sleep(self.polling_interval)
+
+    def check_recovery(self):
+        """Escalate through the recovery tiers while there is no data."""
+        n = self._empty_packet_count
+        if n < self.recovery_packets or n % self.recovery_packets:
+            return
+        tier = n // self.recovery_packets
+        if tier > len(RECOVERY_TIERS) and self.recovery_restart:
+            msg = "Restarting communication after %d empty packets" % n
+            logerr(msg)
+            self._service.dumpFrames(msg)
+            raise weewx.WeeWxIOError('%s; press [USB] to sync' % msg)
+        name = RECOVERY_TIERS[(tier - 1) % len(RECOVERY_TIERS)]
+        loginf('no data after %d empty packets; recover with %s' % (n, name))
+        if self._recovery_ts is None:
+            # keep the frames that led up to the loss of data
+            self._service.dumpFrames('no data after %d empty packets' % n)
+            self._recovery_ts = clock.monotonic()
+        self._recovery_tier = name
+        stats = self._recovery_stats.setdefault(
+            name, {'attempts': 0, 'recovered': 0, 'time': 0.0})
+        stats['attempts'] += 1
+        self._service.requestRecovery(name)
+
+    def recovery_succeeded(self, now):
+        dur = now - self._recovery_ts
+        loginf('communication recovered by %s after %d seconds' %
+               (self._recovery_tier, dur))
+        stats = self._recovery_stats[self._recovery_tier]
+        stats['recovered'] += 1
+        stats['time'] += dur
+        self._recovery_tier = None
+        self._recovery_ts = None
+
+    def log_frame_rate(self, now):
+        """Log how many weather frames per minute arrive from the console."""
+        if now - self._frame_rate_ts < self._log_interval:
+            return
+        n = self._service.getRFStats().get('weather_frames', 0)
+        if self._frame_rate_count is not None:
+            self._frame_rate = (60.0 * (n - self._frame_rate_count) /
+                                (now - self._frame_rate_ts))
+            loginf('current weather frames per minute: %.1f' %
+                   self._frame_rate)
+        self._frame_rate_ts = now
+        self._frame_rate_count = n
 
     def genStartupRecords(self, ts):
         loginf('Scanning historical records')
         self.clear_wait_at_start()  # let rf communication start
-        maxtries = 65
-        ntries = 0
-        last_n = n = nrem = None
-        last_ts = now = int(time.time())
-        self.start_caching_history(since_ts=ts)
-        while nrem is None or nrem > 0:
-            if ntries >= maxtries:
-                logerr('No historical data after %d tries' % ntries)
+        job = HistoryJob(self, since_ts=ts, last_ts=ts,
+                         timeout=self.history_timeout)
+        job.start()
+        self._backfill = job
+        start_ts = last_log_ts = int(clock.monotonic())
+        while True:
+            for r in job.update():
+                r['usUnits'] = weewx.METRIC
+                yield r
+            if job.state != 'running':
+                break
+            now = int(clock.monotonic())
+            if (self.backfill_wait is not None and
+                now - start_ts >= self.backfill_wait):
+                loginf('Continue scanning historical records in background')
                 return
-            time.sleep(60)
-            ntries += 1
-            now = int(time.time())
-            n = self.get_num_history_scanned()
-            if n == last_n:
-                dur = now - last_ts
-                loginf('No data after %d seconds (press SET to sync)' % dur)
-            else:
-                ntries = 0
-                last_ts = now
-            last_n = n
-            nrem = self.get_uncached_history_count()
-            ni = self.get_next_history_index()
-            li = self.get_latest_history_index()
-            loginf("Scanned %s records: current=%s latest=%s remaining=%s" %
-                   (n, ni, li, nrem))
-        self.stop_caching_history()
-        records = self.get_history_cache_records()
-        self.clear_history_cache()
-        loginf('Found %d historical records' % len(records))
-        last_ts = None
+            if now - last_log_ts >= 60:
+                if now - job.last_change >= 60:
+                    loginf('No data after %d seconds (press SET to sync)' %
+                           (now - job.last_change))
+                loginf("Scanned %s records: current=%s latest=%s"
+                       " remaining=%s" %
+                       (job.scanned, job.current, job.latest, job.remaining))
+                last_log_ts = now
+            time.sleep(self.backfill_poll)
+        self._backfill = None
+        self.finish_backfill(job)
+
+    def genArchiveRecords(self, since_ts):
+        """Return the records of a history scan that continued in the
+        background after genStartupRecords returned."""
+        self.update_backfill()
+        records = self._backfill_records
+        self._backfill_records = []
         for r in records:
-            if last_ts is not None and r['dateTime'] is not None:
-                r['usUnits'] = weewx.METRIC
-                r['interval'] = (r['dateTime'] - last_ts) / 60
+            if since_ts is None or r['dateTime'] > since_ts:
                 yield r
-            last_ts = r['dateTime']
+
+    def update_backfill(self):
+        job = self._backfill
+        if job is None:
+            if self.hardware_record_generation:
+                self.start_archive_job()
+            return
+        records = job.update()
+        if self.hardware_record_generation:
+            for r in records:
+                r['usUnits'] = weewx.METRIC
+                self._backfill_records.append(r)
+        elif records:
+            # genArchiveRecords is not called with software record
+            # generation, so nothing would ever take these records
+            logdbg('discard %d historical records scanned in background' %
+                   len(records))
+        if job.state != 'running':
+            self._backfill = None
+            self.finish_backfill(job)
+
+    def start_archive_job(self):
+        """Start reading the records that the console stored since the
+        last history scan."""
+        latest = self.get_latest_history_index()
+        if latest is None:
+            return
+        if self._archive_index is None:
+            self._archive_index = latest
+        if latest == self._archive_index:
+            return
+        job = HistoryJob(self, count=get_index(latest - self._archive_index),
+                         last_ts=self._archive_last_ts,
+                         timeout=self.history_timeout)
+        if job.start(blocking=False):
+            logdbg('read history records %s to %s' %
+                   (self._archive_index, latest))
+            self._archive_target = latest
+            self._backfill = job
+
+    def finish_backfill(self, job):
+        if job.state == 'timed out':
+            logerr('No historical data after %d seconds' % job.timeout)
+        if job.state == 'done':
+            if self._archive_target is not None:
+                self._archive_index = self._archive_target
+            elif job.latest is not None:
+                self._archive_index = job.latest
+            if job.proc.last_ts is not None:
+                self._archive_last_ts = job.proc.last_ts
+        msg = ('Found %d historical records: duplicates=%d dropped=%d'
+               ' gaps=%d' % (job.scanned, job.proc.num_duplicate,
+                             job.proc.num_dropped, job.proc.num_gaps))
+        if self._archive_target is None:
+            loginf(msg)
+        else:
+            logdbg(msg)
+        self._archive_target = None
+        self.save_rain_state()
 
     def startUp(self):
         if self._service is not None:
             return
-        self._service = CommunicationService(self.first_sleep)
+        if self.rf_process:
+            self._service = RFProcess(self.first_sleep, self.rf_priority,
+                                      self.rf_cpus)
+        else:
+            self._service = CommunicationService(self.first_sleep)
+        self.load_rain_state()
         self._service.setup(self.frequency, self.comm_interval,
-                            self.vendor_id, self.product_id, self.config_serial)
+                            self.vendor_id, self.product_id, self.config_serial,
+                            self.fast_current_weather, self.comm_controller,
+                            self.flash_cache_file, self.usb_retries,
+                            self.usb_reconnect_timeout,
+                            FrameRecorder(self.frame_ring_size,
+                                          self.frame_dump_dir))
         self._service.startRFThread()
+        if self.profile_signal is not None and self._profile_handler is None:
+            self.install_profile_handler()
+        if self.control_socket is not None:
+            self._control = ControlServer(self, self.control_socket)
+            self._control.startServer()
+        if self.shm_file is not None and self._publisher is None:
+            try:
+                self._publisher = ObservationPublisher(self.shm_file)
+            except (IOError, OSError, mmap.error), e:
+                logerr('cannot publish to %s: %s' % (self.shm_file, e))
+        if self.multicast_address is not None and self._multicast is None:
+            try:
+                self._multicast = MulticastPublisher(
+                    self.multicast_address, fmt=self.multicast_format,
+                    ttl=self.multicast_ttl)
+            except (socket.error, ValueError), e:
+                logerr('cannot send to %s: %s' % (self.multicast_address, e))
 
     def shutDown(self):
+        if self._backfill is not None:
+            self._backfill.cancel()
+            self._backfill = None
+        if self._control is not None:
+            self._control.stopServer()
+            self._control = None
+        if self._publisher is not None:
+            self._publisher.close()
+            self._publisher = None
+        if self._multicast is not None:
+            self._multicast.close()
+            self._multicast = None
+        if self._profile_handler is not None:
+            signal.signal(getattr(signal, self.profile_signal),
+                          self._profile_handler)
+            self._profile_handler = None
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
         self._service.stopRFThread()
         self._service.teardown()
         self._service = None
 
+    def install_profile_handler(self):
+        try:
+            signum = getattr(signal, self.profile_signal)
+            self._profile_handler = signal.signal(
+                signum, lambda n, f: self.on_profile_signal())
+            loginf('send %s to profile the driver' % self.profile_signal)
+        except (AttributeError, TypeError, ValueError), e:
+            # signal handlers can be installed only in the main thread
+            logerr('cannot profile on signal %s: %s' %
+                   (self.profile_signal, e))
+            self._profile_handler = None
+
+    def on_profile_signal(self):
+        # the handler runs in the driver thread between two bytecodes, so
+        # it must not wait for locks the driver thread may hold, such as
+        # those of the rf process ring.  start profiling from another thread.
+        t = threading.Thread(target=self.start_profile)
+        t.setName('WS28xxProfileStart')
+        t.setDaemon(True)
+        t.start()
+
+    def start_profile(self, duration=None):
+        """Start profiling the driver thread and the RF thread.  Return the
+        names of the files to which the profiles will be written, or None
+        if profiling is already running."""
+        with self._profile_lock:
+            if self._profiler is not None and self._profiler.running:
+                loginf('profile is already running')
+                return None
+            if duration is None:
+                duration = self.profile_duration
+            threads = [self._driver_thread]
+            paths = []
+            if self.rf_process:
+                # the RF thread is in another process, so profile it there
+                path = self._service.startProfile(
+                    duration, self.profile_interval, self.profile_dir,
+                    self.profile_format)
+                if path is not None:
+                    paths.append(path)
+            else:
+                threads.append('RFComm')
+            self._profiler = SamplingProfiler(
+                threads, duration, self.profile_interval, self.profile_dir,
+                self.profile_format)
+            paths.insert(0, self._profiler.start())
+            return paths
+
+    def load_rain_state(self):
+        if self.rain_state_file is None:
+            return
+        try:
+            f = open(self.rain_state_file)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            self._service.history_rain.from_dict(state.get('history', {}))
+            logdbg('loaded rain state: %s' % state)
+        except (IOError, ValueError), e:
+            loginf('cannot read rain state from %s: %s' %
+                   (self.rain_state_file, e))
+
+    def save_rain_state(self):
+        if self.rain_state_file is None:
+            return
+        state = {'history': self._service.history_rain.to_dict()}
+        try:
+            f = open(self.rain_state_file, 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+        except IOError, e:
+            logerr('cannot save rain state to %s: %s' %
+                   (self.rain_state_file, e))
+
     def transceiver_is_present(self):
         return self._service.getTransceiverPresent()
 
@@ -1473,80 +2147,73 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
     def get_transceiver_serial(self):
         return self._service.getTransceiverSerNo()
 
+    def wait_for_change(self, predicate, timeout):
+        """Wait until predicate() is true, checking each time the RF thread
+        has handled a frame.  Return False if that does not happen within
+        timeout seconds."""
+        return self._service.waitForChange(predicate, timeout)
+
     def get_transceiver_id(self):
         return self._service.getDeviceID()
 
     def get_last_contact(self):
         return self._service.getLastStat().last_seen_ts
 
+    def get_link_stats(self):
+        laststat = self._service.getLastStat()
+        return {
+            'present': self.transceiver_is_present(),
+            'paired': self.transceiver_is_paired(),
+            'serial': self.get_transceiver_serial(),
+            'id': self.get_transceiver_id(),
+            'link_quality': getattr(laststat, 'LastLinkQuality', None),
+            'battery_status': getattr(laststat, 'LastBatteryStatus', None),
+            'last_seen_ts': laststat.last_seen_ts,
+            'last_weather_ts': laststat.last_weather_ts,
+            'last_history_ts': laststat.last_history_ts,
+            'last_config_ts': laststat.last_config_ts,
+            'packet_count': self._packet_count,
+            'empty_packet_count': self._empty_packet_count,
+            'weather_frames_per_minute': self._frame_rate,
+            'recovery': self._recovery_stats,
+            'rf': self._service.getRFStats()}
+
     def get_observation(self):
         data = self._service.getCurrentData()
-        ts = data._timestamp
-        if ts is None:
+        if data._timestamp is None:
             return None
 
-        # add elements required for weewx LOOP packets
-        packet = {}
-        packet['usUnits'] = weewx.METRIC
-        packet['dateTime'] = ts
-
-        # data from the station sensors
-        packet['inTemp']      = get_datum_diff(data._TempIndoor,
-                                               CWeatherTraits.TemperatureNP(),
-                                               CWeatherTraits.TemperatureOFL())
-        packet['inHumidity']  = get_datum_diff(data._HumidityIndoor,
-                                               CWeatherTraits.HumidityNP(),
-                                               CWeatherTraits.HumidityOFL())
-        packet['outTemp']     = get_datum_diff(data._TempOutdoor,
-                                               CWeatherTraits.TemperatureNP(),
-                                               CWeatherTraits.TemperatureOFL())
-        packet['outHumidity'] = get_datum_diff(data._HumidityOutdoor,
-                                               CWeatherTraits.HumidityNP(),
-                                               CWeatherTraits.HumidityOFL())
-        packet['pressure']    = get_datum_diff(data._PressureRelative_hPa,
-                                               CWeatherTraits.PressureNP(),
-                                               CWeatherTraits.PressureOFL())
-        packet['windSpeed']   = get_datum_diff(data._WindSpeed,
-                                               CWeatherTraits.WindNP(),
-                                               CWeatherTraits.WindOFL())
-        packet['windGust']    = get_datum_diff(data._Gust,
-                                               CWeatherTraits.WindNP(),
-                                               CWeatherTraits.WindOFL())
-
-        packet['windDir'] = getWindDir(data._WindDirection,
-                                       packet['windSpeed'])
-        packet['windGustDir'] = getWindDir(data._GustDirection,
-                                           packet['windGust'])
+        # data from the station sensors, and the signal strength and
+        # battery levels
+        laststat = self._service.getLastStat()
+        packet, rain_total = self._packet_builder.build(
+            data, laststat.LastBatteryStatus)
+        packet['rxCheckPercent'] = laststat.LastLinkQuality
+
+        # vector average of the current and previous wind directions
+        self._wind_average.add_frame(
+            [data._WindDirection, data._WindDirection1,
+             data._WindDirection2, data._WindDirection3,
+             data._WindDirection4, data._WindDirection5])
+        packet['windDirAvg'] = None
+        if packet['windSpeed']:
+            packet['windDirAvg'] = self._wind_average.direction()
 
         # calculated elements not directly reported by station
-        packet['rainRate'] = get_datum_match(data._Rain1H,
-                                             CWeatherTraits.RainNP(),
-                                             CWeatherTraits.RainOFL())
-        if packet['rainRate'] is not None:
-            packet['rainRate'] /= 10  # weewx wants cm/hr
-        rain_total = get_datum_match(data._RainTotal,
-                                     CWeatherTraits.RainNP(),
-                                     CWeatherTraits.RainOFL())
-        delta = weewx.wxformulas.calculate_rain(rain_total, self._last_rain)
-        self._last_rain = rain_total
-        packet['rain'] = delta
+        packet['rain'] = self._rain_counter.update(
+            rain_total, reset=data._LastRainReset)
         if packet['rain'] is not None:
             packet['rain'] /= 10  # weewx wants cm
 
-        # track the signal strength and battery levels
-        laststat = self._service.getLastStat()
-        packet['rxCheckPercent'] = laststat.LastLinkQuality
-        packet['windBatteryStatus'] = getBatteryStatus(
-            laststat.LastBatteryStatus, 'wind')
-        packet['rainBatteryStatus'] = getBatteryStatus(
-            laststat.LastBatteryStatus, 'rain')
-        packet['outTempBatteryStatus'] = getBatteryStatus(
-            laststat.LastBatteryStatus, 'th')
-        packet['inTempBatteryStatus'] = getBatteryStatus(
-            laststat.LastBatteryStatus, 'console')
-
         return packet
 
+    def get_history_interval(self):
+        """the console history interval in minutes, or None if not known"""
+        cfg = self.get_config()
+        if cfg is None:
+            return None
+        return getHistoryInterval(cfg['history_interval'])
+
     def get_config(self):
         logdbg('get station configuration')
         cfg = self._service.getConfigData().asDict()
@@ -1586,6 +2253,607 @@ class WS28xxDriver(weewx.drivers.AbstractDevice):
         # FIXME: set the archive interval
         pass
 
+# observations published by ObservationPublisher, in layout order
+PUBLISHED_FIELDS = [
+    'dateTime', 'inTemp', 'inHumidity', 'outTemp', 'outHumidity',
+    'pressure', 'windSpeed', 'windGust', 'windDir', 'windGustDir',
+    'rainRate', 'rain', 'rxCheckPercent', 'windBatteryStatus',
+    'rainBatteryStatus', 'outTempBatteryStatus', 'inTempBatteryStatus']
+# LastStat attributes published by ObservationPublisher, in layout order
+PUBLISHED_STATS = [
+    ('last_seen_ts', 'last_seen_ts'),
+    ('last_weather_ts', 'last_weather_ts'),
+    ('last_history_ts', 'last_history_ts'),
+    ('last_config_ts', 'last_config_ts'),
+    ('link_quality', 'LastLinkQuality'),
+    ('battery_status', 'LastBatteryStatus'),
+    ('latest_history_index', 'latest_history_index')]
+SHM_MAGIC = 'WS28'
+SHM_VERSION = 2
+# magic, version, number of values, padding to align the sequence number
+SHM_HEADER = struct.Struct('<4sIII')
+SHM_SEQ = struct.Struct('<Q')
+
+
+class ObservationPublisher(object):
+    """Publish the latest observation and link status to a memory-mapped
+    file so that other processes can read them without the database.
+
+    The layout of the file, all values little-endian:
+
+      offset  0: 'WS28', uint32 version, uint32 number of values n,
+                 uint32 zero
+      offset 16: uint64 sequence number
+      offset 24: n float64 values, NaN where there is no value
+      offset 24+8n: the names of the values, each terminated by a null
+
+    The values are those of PUBLISHED_FIELDS followed by those of
+    PUBLISHED_STATS.  The sequence number is odd while the values are
+    being written, so a reader reads the sequence number, the values,
+    then the sequence number again, and retries if the two numbers differ
+    or are odd.  See ObservationReader.
+
+    This assumes that the processor makes the stores of one process
+    visible to others in the order they were made, as x86 does; python
+    has no way to add memory barriers.  The sequence number is aligned to
+    8 bytes so that it is stored in one access on 64-bit processors.  On
+    32-bit processors a reader can see half of an update to it, which
+    makes the two reads differ, so the reader retries.
+
+    A file with the same layout is reused as it is, so readers that have
+    it mapped keep working when the driver restarts.  Otherwise a new file
+    is created and renamed into place; readers of the old file must open
+    the new one to see new values."""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = PUBLISHED_FIELDS + [x[0] for x in PUBLISHED_STATS]
+        self.values = struct.Struct('<%dd' % len(self.names))
+        self.offset = SHM_HEADER.size + SHM_SEQ.size
+        header = SHM_HEADER.pack(SHM_MAGIC, SHM_VERSION, len(self.names), 0)
+        names = ''.join([x + '\0' for x in self.names])
+        self.mm = self._open_existing(header, names)
+        if self.mm is None:
+            nan = float('nan')
+            self.seq = 0
+            self.mm = self._create(
+                header + SHM_SEQ.pack(self.seq) +
+                self.values.pack(*([nan] * len(self.names))) + names)
+
+    def _open_existing(self, header, names):
+        size = self.offset + self.values.size + len(names)
+        try:
+            f = open(self.path, 'r+b')
+        except IOError:
+            return None
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != size:
+                return None
+            mm = mmap.mmap(f.fileno(), size)
+        finally:
+            f.close()
+        if (mm[0:len(header)] != header or
+            mm[self.offset + self.values.size:size] != names):
+            mm.close()
+            return None
+        # if the previous publisher died while writing, the sequence
+        # number is odd
+        (seq,) = SHM_SEQ.unpack_from(mm, SHM_HEADER.size)
+        self.seq = seq + (seq & 1)
+        SHM_SEQ.pack_into(mm, SHM_HEADER.size, self.seq)
+        return mm
+
+    def _create(self, data):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        f = open(tmp, 'w+b')
+        try:
+            f.write(data)
+            f.flush()
+            mm = mmap.mmap(f.fileno(), len(data))
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        return mm
+
+    def publish(self, packet, laststat):
+        nan = float('nan')
+        values = [packet.get(x) for x in PUBLISHED_FIELDS]
+        values.extend([getattr(laststat, x[1], None) for x in PUBLISHED_STATS])
+        self.write([nan if v is None else v for v in values])
+
+    def write(self, values):
+        self.seq += 1
+        SHM_SEQ.pack_into(self.mm, SHM_HEADER.size, self.seq)
+        self.values.pack_into(self.mm, self.offset, *values)
+        self.seq += 1
+        SHM_SEQ.pack_into(self.mm, SHM_HEADER.size, self.seq)
+
+    def close(self):
+        self.mm.close()
+
+
+class ObservationReader(object):
+    """Read the values published by an ObservationPublisher."""
+
+    max_tries = 100  # give up on a publisher that stopped while writing
+    retry_wait = 0.001  # seconds
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, n, _ = SHM_HEADER.unpack_from(self.mm, 0)
+        if magic != SHM_MAGIC or version != SHM_VERSION:
+            raise ValueError('%s is not a ws28xx observation file' % path)
+        self.values = struct.Struct('<%dd' % n)
+        self.offset = SHM_HEADER.size + SHM_SEQ.size
+        names = self.mm[self.offset + self.values.size:]
+        self.names = names.split('\0')[:n]
+
+    def read(self):
+        """Return a dict of the latest values, with None for no value.
+        Raise IOError if no consistent values could be read, for example
+        because the publisher stopped while writing."""
+        for _ in xrange(self.max_tries):
+            (seq,) = SHM_SEQ.unpack_from(self.mm, SHM_HEADER.size)
+            if not seq & 1:
+                values = self.values.unpack_from(self.mm, self.offset)
+                if SHM_SEQ.unpack_from(self.mm, SHM_HEADER.size)[0] == seq:
+                    break
+            time.sleep(self.retry_wait)
+        else:
+            raise IOError('no consistent values in observation file')
+        return dict(zip(self.names,
+                        [None if v != v else v for v in values]))
+
+    def close(self):
+        self.mm.close()
+
+
+MULTICAST_HEADER = struct.Struct('<4sIQd')  # magic, version, seq, sent
+
+
+def parse_multicast_address(address):
+    group, port = address.rsplit(':', 1)
+    return group, int(port)
+
+
+class MulticastPublisher(object):
+    """Send each observation as a datagram to a multicast group.
+
+    Each datagram has a sequence number, so listeners can detect lost
+    packets, and the time at which it was sent.  In json format a datagram
+    is an object with 'seq', 'sent' and 'packet'.  In binary format it is
+    the magic 'WS28', uint32 version, uint64 sequence number and float64
+    time sent, followed by the float64 values of PUBLISHED_FIELDS, with NaN
+    where there is no value, all little-endian."""
+
+    def __init__(self, address, fmt='json', ttl=1):
+        if fmt not in ['json', 'binary']:
+            raise ValueError('unknown multicast format %s' % fmt)
+        self.address = parse_multicast_address(address)
+        self.fmt = fmt
+        self.values = struct.Struct('<%dd' % len(PUBLISHED_FIELDS))
+        self.seq = 0
+        self.errors = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                  socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        loginf('multicast to %s:%s (%s)' %
+               (self.address[0], self.address[1], fmt))
+
+    def encode(self, packet, sent):
+        if self.fmt == 'json':
+            return json.dumps({'seq': self.seq, 'sent': sent,
+                               'packet': packet}, separators=(',', ':'))
+        nan = float('nan')
+        values = [packet.get(x) for x in PUBLISHED_FIELDS]
+        return (MULTICAST_HEADER.pack(SHM_MAGIC, SHM_VERSION, self.seq, sent) +
+                self.values.pack(*[nan if v is None else v for v in values]))
+
+    def publish(self, packet):
+        self.seq += 1
+        try:
+            self.sock.sendto(self.encode(packet, clock.time()), self.address)
+        except socket.error, e:
+            self.errors += 1
+            if self.errors == 1 or self.errors % 100 == 0:
+                logerr('multicast send failed (%d errors): %s' %
+                       (self.errors, e))
+
+    def close(self):
+        self.sock.close()
+
+
+class MulticastListener(object):
+    """Receive the datagrams sent by a MulticastPublisher and keep track of
+    lost and reordered datagrams."""
+
+    def __init__(self, address):
+        self.address = parse_multicast_address(address)
+        self.values = struct.Struct('<%dd' % len(PUBLISHED_FIELDS))
+        self.last_seq = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.restarts = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                  socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.address[1]))
+        mreq = struct.pack('4s4s', socket.inet_aton(self.address[0]),
+                           socket.inet_aton('0.0.0.0'))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             mreq)
+
+    def decode(self, data):
+        if data.startswith(SHM_MAGIC):
+            _, _, seq, sent = MULTICAST_HEADER.unpack_from(data, 0)
+            values = self.values.unpack_from(data, MULTICAST_HEADER.size)
+            packet = dict(zip(PUBLISHED_FIELDS,
+                              [None if v != v else v for v in values]))
+            return seq, sent, packet
+        msg = json.loads(data)
+        return msg['seq'], msg['sent'], msg['packet']
+
+    def recv(self, timeout=None):
+        """Return (seq, sent, packet) or None after timeout seconds."""
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return None
+        seq, sent, packet = self.decode(data)
+        self.received += 1
+        if seq == 1 and self.last_seq is not None:
+            self.restarts += 1  # the sender was restarted
+            self.last_seq = None
+        if self.last_seq is not None:
+            if seq > self.last_seq + 1:
+                self.lost += seq - self.last_seq - 1
+            elif seq <= self.last_seq:
+                self.reordered += 1
+        if self.last_seq is None or seq > self.last_seq:
+            self.last_seq = seq
+        return seq, sent, packet
+
+    def close(self):
+        self.sock.close()
+
+
+class HistoryJob(object):
+    """Read history records from the station while the RF thread keeps
+    reading current weather.  Call update periodically; it returns the
+    records that arrived since the previous call, cleaned up by a
+    HistoryProcessor.  Only one job can use the history cache at a time.
+
+    since_ts: read records at or after this timestamp
+    count: read this many records, if non-zero
+    last_ts: the timestamp of the last record already stored, if any
+    timeout: give up after this many seconds without a new record
+    keep_records: also collect the records in self.records, for callers
+                  that want them all at the end rather than as they arrive"""
+
+    def __init__(self, driver, since_ts=0, count=0, last_ts=None,
+                 timeout=600, keep_records=False):
+        self.driver = driver
+        self.since_ts = since_ts
+        self.count = count
+        self.timeout = timeout
+        self.proc = HistoryProcessor(last_ts=last_ts)
+        self.records = [] if keep_records else None
+        self.state = None
+        self.scanned = 0
+        self.current = None
+        self.latest = None
+        self.remaining = None
+        self.last_change = None
+        self._pos = 0
+
+    def start(self, blocking=True):
+        if not self.driver._history_lock.acquire(blocking):
+            return False
+        self.state = 'running'
+        self.last_change = int(clock.monotonic())
+        self.driver.start_caching_history(since_ts=self.since_ts,
+                                          num_rec=self.count)
+        return True
+
+    def update(self):
+        if self.state != 'running':
+            return []
+        now = int(clock.monotonic())
+        n = self.driver.get_num_history_scanned()
+        if n != self.scanned:
+            self.scanned = n
+            self.last_change = now
+        self.current = self.driver.get_next_history_index()
+        self.latest = self.driver.get_latest_history_index()
+        self.remaining = self.driver.get_uncached_history_count()
+        if self.proc.interval is None:
+            self.proc.interval = self.driver.get_history_interval()
+        cached = self.driver.get_history_cache_records()
+        new = cached[self._pos:]
+        self._pos += len(new)
+        ready = []
+        for r in new:
+            ready.extend(self.proc.add(r))
+        if self.remaining is not None and self.remaining <= 0:
+            ready.extend(self.proc.flush())
+            self.finish('done')
+        elif now - self.last_change > self.timeout:
+            ready.extend(self.proc.flush())
+            self.finish('timed out')
+        if self.records is not None:
+            self.records.extend(ready)
+        return ready
+
+    def cancel(self):
+        if self.state == 'running':
+            self.finish('cancelled')
+
+    def finish(self, state):
+        self.state = state
+        try:
+            self.driver.stop_caching_history()
+            self.driver.clear_history_cache()
+        finally:
+            self.driver._history_lock.release()
+
+    def status(self):
+        return {'state': self.state, 'scanned': self.scanned,
+                'current': self.current, 'latest': self.latest,
+                'remaining': self.remaining}
+
+
+class ControlServer(object):
+    """Answer queries from local tools on a Unix-domain socket while the
+    driver is running.
+
+    Each connection carries one request and one reply, each a JSON object
+    on a single line.  The request names a command in 'cmd':
+
+      current - the most recent LOOP packet
+      config  - the station configuration
+      link    - transceiver and link status
+      history - start a history download job, with optional 'since_ts'
+                and 'count'.  The reply contains the job id.
+      job     - status of the history job with the given 'id'.  Once the
+                job is done the reply contains the records.
+      profile - profile the driver for 'duration' seconds.  The reply
+                contains the names of the profile files.
+
+    Errors are reported in the 'error' element of the reply."""
+
+    job_timeout = 600  # abandon a history job after this many idle seconds
+
+    def __init__(self, driver, path):
+        self.driver = driver
+        self.path = path
+        self.sock = None
+        self.running = False
+        self.child = None
+        self.job = None
+        self.job_count = 0
+
+    def startServer(self):
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                logerr('control socket %s exists and is not a socket' %
+                       self.path)
+                return
+            os.unlink(self.path)  # left over from a previous run
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            self.sock.listen(5)
+        except socket.error, e:
+            logerr('cannot open control socket %s: %s' % (self.path, e))
+            self.sock = None
+            return
+        loginf('control socket is %s' % self.path)
+        self.running = True
+        self.child = threading.Thread(target=self.run)
+        self.child.setName('WS28xxControl')
+        self.child.setDaemon(True)
+        self.child.start()
+
+    def stopServer(self):
+        self.running = False
+        if self.child is not None:
+            self.child.join(5)
+            self.child = None
+        if self.job is not None:
+            self.job.cancel()
+
+    def run(self):
+        try:
+            while self.running:
+                try:
+                    rd, _, _ = select.select([self.sock], [], [], 1.0)
+                    if rd:
+                        conn, _ = self.sock.accept()
+                        self.handle_connection(conn)
+                except (select.error, socket.error), e:
+                    # for example a signal interrupted the select
+                    logdbg('control socket: %s' % (e,))
+                try:
+                    self.update_job()
+                except Exception, e:
+                    logerr('control socket: history job %s failed: %s' %
+                           (self.job_count, e))
+                    try:
+                        self.job.cancel()
+                    except Exception:
+                        pass
+        except Exception, e:
+            logerr('exception in control socket: %s' % e)
+            log_traceback(dst=syslog.LOG_INFO)
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def handle_connection(self, conn):
+        try:
+            conn.settimeout(5)
+            data = ''
+            while not data.endswith('\n'):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                reply = self.dispatch(json.loads(data))
+            except (ValueError, TypeError, AttributeError), e:
+                reply = {'error': 'bad request: %s' % e}
+            except Exception, e:
+                # for example the driver is reopening the transceiver.  a
+                # failed request must not take down the control socket.
+                logerr('control socket: %s failed: %s' % (data.strip(), e))
+                reply = {'error': str(e)}
+            conn.sendall(json.dumps(reply) + '\n')
+        except socket.error, e:
+            logdbg('control socket: %s' % e)
+        finally:
+            conn.close()
+
+    def dispatch(self, req):
+        cmd = req.get('cmd')
+        if cmd == 'ping':
+            return {'version': DRIVER_VERSION}
+        if cmd == 'current':
+            return {'current': self.driver._last_packet}
+        if cmd == 'config':
+            return {'config': self.driver.get_config()}
+        if cmd == 'link':
+            return {'link': self.driver.get_link_stats()}
+        if cmd == 'history':
+            return self.start_job(int(req.get('since_ts') or 0),
+                                  int(req.get('count') or 0))
+        if cmd == 'job':
+            if self.job is None or self.job_count != req.get('id'):
+                return {'error': 'no such job %s' % req.get('id')}
+            reply = self.job.status()
+            reply['id'] = self.job_count
+            reply['records'] = None
+            if self.job.state == 'done':
+                reply['records'] = self.job.records
+            return reply
+        if cmd == 'profile':
+            duration = req.get('duration')
+            if duration is not None:
+                duration = float(duration)
+            paths = self.driver.start_profile(duration)
+            if paths is None:
+                return {'error': 'profile is already running'}
+            return {'profile': paths}
+        return {'error': 'unknown command %s' % cmd}
+
+    def start_job(self, since_ts, count):
+        if self.job is not None and self.job.state == 'running':
+            return {'error': 'history job %s is running' % self.job_count}
+        job = HistoryJob(self.driver, since_ts=since_ts, count=count,
+                         timeout=self.job_timeout, keep_records=True)
+        if not job.start(blocking=False):
+            return {'error': 'driver is reading history'}
+        self.job = job
+        self.job_count += 1
+        loginf('control socket: start history job %s' % self.job_count)
+        return {'job': self.job_count}
+
+    def update_job(self):
+        if self.job is not None and self.job.state == 'running':
+            self.job.update()
+            if self.job.state != 'running':
+                loginf('control socket: history job %s %s' %
+                       (self.job_count, self.job.state))
+
+
+class ControlClient(object):
+    """Query a running driver through its control socket.  This provides
+    the subset of the WS28xxDriver interface used by the configurator."""
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, cmd, **kwargs):
+        req = dict(kwargs)
+        req['cmd'] = cmd
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(req) + '\n')
+            data = ''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            sock.close()
+        return json.loads(data)
+
+    def ping(self):
+        try:
+            return 'version' in self.request('ping')
+        except (socket.error, ValueError):
+            return False
+
+    def closePort(self):
+        pass
+
+    def get_observation(self):
+        return self.request('current')['current']
+
+    def get_config(self):
+        return self.request('config')['config']
+
+    def get_link_stats(self):
+        return self.request('link')['link']
+
+    def start_profile(self, duration=None):
+        reply = self.request('profile', duration=duration)
+        if 'error' in reply:
+            raise weewx.WeeWxIOError(reply['error'])
+        return reply['profile']
+
+    def transceiver_is_present(self):
+        return self.get_link_stats()['present']
+
+    def transceiver_is_paired(self):
+        return self.get_link_stats()['paired']
+
+    def get_transceiver_serial(self):
+        return self.get_link_stats()['serial']
+
+    def get_transceiver_id(self):
+        return self.get_link_stats()['id']
+
+    def wait_for_change(self, predicate, timeout, interval=0.5):
+        """Wait until predicate() is true.  The driver does not tell us
+        when something changes, so query it every interval seconds."""
+        end = clock.monotonic() + timeout
+        while not predicate():
+            if clock.monotonic() >= end:
+                return False
+            time.sleep(interval)
+        return True
+
+    def start_history_job(self, since_ts=0, count=0):
+        return self.request('history', since_ts=since_ts, count=count)
+
+    def get_history_job(self, job_id):
+        return self.request('job', id=job_id)
+
+
 # The following classes and methods are adapted from the implementation by
 # eddie de pieri, which is in turn based on the HeavyWeather implementation.
 
@@ -1717,12 +2985,79 @@ class EWindDirection:
     wdNone           = 0x12
 
 
-def getWindDir(wdir, wspeed):
-    if wspeed is None or wspeed == 0:
-        return None
-    if wdir < 0 or wdir >= 16:
-        return None
-    return wdir * 360 / 16
+# degrees for each console wind direction.  the 16 compass points are
+# followed by None for wdERR, wdInvalid, wdNone and any other value of a
+# byte, so that a direction can be used as an index without checking it.
+WIND_DIR_DEGREES = [i * 360 / 16 for i in xrange(16)] + [None] * 240
+
+# the packet fields for the current and previous wind and gust directions
+WIND_DIR_FIELDS = (['windDir'] + ['windDir%d' % i for i in xrange(1, 6)] +
+                   ['windGustDir'] + ['windGustDir%d' % i for i in xrange(1, 6)])
+
+
+def getWindDirs(wdirs, wspeeds):
+    """Convert wind directions to degrees in bulk.  wdirs and wspeeds are
+    sequences of the same length.  The direction is None where there is
+    no wind."""
+    table = WIND_DIR_DEGREES
+    return [table[d] if v else None for d, v in zip(wdirs, wspeeds)]
+
+
+# unit vector (east, north) for each of the 16 console wind directions
+WIND_VECTORS = [(math.sin(math.radians(i * 22.5)),
+                 math.cos(math.radians(i * 22.5))) for i in xrange(16)]
+
+
+class WindVectorAverage(object):
+    """Average of the most recent wind directions.  The directions are
+    added as unit vectors, so that directions either side of north
+    average correctly, and the average is not limited to the 16 points
+    of the console.  Adding a direction and dropping the oldest takes
+    constant time.
+
+    Each weather frame has the current direction and the 5 before it.
+    add_frame adds only the directions that were not in the previous
+    frame.  If the directions do not line up with the previous frame at
+    any shift, frames were missed and only the current direction is
+    added, rather than adding the 5 before it a second time."""
+
+    def __init__(self, size=6):
+        self.size = size
+        self.samples = collections.deque()
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.last = None
+
+    def add(self, wdir):
+        x, y = WIND_VECTORS[wdir]
+        self.samples.append(wdir)
+        self.sum_x += x
+        self.sum_y += y
+        if len(self.samples) > self.size:
+            x, y = WIND_VECTORS[self.samples.popleft()]
+            self.sum_x -= x
+            self.sum_y -= y
+
+    def add_frame(self, dirs):
+        """Add the directions of a frame, most recent first."""
+        n = len(dirs)
+        if self.last is not None:
+            # find how far the directions shifted since the previous frame
+            for n in xrange(len(dirs)):
+                if dirs[n:] == self.last[:len(dirs) - n]:
+                    break
+            else:
+                n = 1
+        self.last = list(dirs)
+        for wdir in reversed(dirs[:n]):
+            if 0 <= wdir < 16:
+                self.add(wdir)
+
+    def direction(self):
+        """The average direction in degrees, or None if there is none."""
+        if abs(self.sum_x) < 1e-6 and abs(self.sum_y) < 1e-6:
+            return None
+        return math.degrees(math.atan2(self.sum_x, self.sum_y)) % 360
 
 
 class EResetMinMaxFlags:
@@ -1779,14 +3114,22 @@ RESPONSE_REQ_SET_TIME = 0xa3
 batterybits = {'th': 0, 'rain': 1, 'wind': 2, 'console': 3}
 
 
-def getBatteryStatus(status, flag):
-    """Return 1 if bit is set, 0 otherwise"""
-    bit = batterybits.get(flag)
-    if bit is None:
-        return None
-    if BitHandling.testBit(status, bit):
-        return 1
-    return 0
+# the battery flag of each sensor for each value of the battery status
+# nibble
+BATTERY_STATUS = [dict([(flag, (n >> bit) & 1)
+                        for flag, bit in batterybits.items()])
+                  for n in xrange(16)]
+
+# the packet field for the battery of each sensor
+BATTERY_FIELDS = [('windBatteryStatus', 'wind'),
+                  ('rainBatteryStatus', 'rain'),
+                  ('outTempBatteryStatus', 'th'),
+                  ('inTempBatteryStatus', 'console')]
+
+# the packet fields for each value of the battery status nibble
+BATTERY_PACKET_FIELDS = [dict([(name, BATTERY_STATUS[n][flag])
+                               for name, flag in BATTERY_FIELDS])
+                         for n in xrange(16)]
 
 
 history_intervals = {
@@ -1810,6 +3153,148 @@ def getHistoryInterval(i):
 
 # NP - not present
 # OFL - outside factory limits
+TEMPERATURE_NP = 81.099998
+TEMPERATURE_OFL = 136.0
+TEMPERATURE_OFFSET = 40.0
+PRESSURE_NP = 10101010.0
+PRESSURE_OFL = 16666.5
+HUMIDITY_NP = 110.0
+HUMIDITY_OFL = 121.0
+RAIN_NP = -0.2
+RAIN_OFL = 16666.664
+WIND_NP = 183.6    # km/h = 51.0 m/s
+WIND_OFL = 183.96  # km/h = 51.099998 m/s
+
+# sentinel values for each observation that is reported in a LOOP packet.
+# each entry is (CurrentData attribute, not-present value, overflow value,
+# fuzzy).  fuzzy values are compared with a tolerance since they are the
+# result of floating point decoding.
+OBSERVATION_SENTINELS = [
+    ('_TempIndoor', TEMPERATURE_NP, TEMPERATURE_OFL, True),
+    ('_HumidityIndoor', HUMIDITY_NP, HUMIDITY_OFL, True),
+    ('_TempOutdoor', TEMPERATURE_NP, TEMPERATURE_OFL, True),
+    ('_HumidityOutdoor', HUMIDITY_NP, HUMIDITY_OFL, True),
+    ('_PressureRelative_hPa', PRESSURE_NP, PRESSURE_OFL, True),
+    ('_WindSpeed', WIND_NP, WIND_OFL, True),
+    ('_Gust', WIND_NP, WIND_OFL, True),
+    ('_Rain1H', RAIN_NP, RAIN_OFL, False),
+    ('_RainTotal', RAIN_NP, RAIN_OFL, False),
+    ]
+
+# fields of a LOOP packet that come from CurrentData.  each entry is
+# (packet field, CurrentData attribute, not-present value, overflow value,
+# fuzzy, divisor), as in OBSERVATION_SENTINELS.  the value is divided by
+# divisor to get weewx units.
+LOOP_FIELDS = [
+    ('inTemp', '_TempIndoor', TEMPERATURE_NP, TEMPERATURE_OFL, True, None),
+    ('inHumidity', '_HumidityIndoor', HUMIDITY_NP, HUMIDITY_OFL, True, None),
+    ('outTemp', '_TempOutdoor', TEMPERATURE_NP, TEMPERATURE_OFL, True, None),
+    ('outHumidity', '_HumidityOutdoor', HUMIDITY_NP, HUMIDITY_OFL, True,
+     None),
+    ('pressure', '_PressureRelative_hPa', PRESSURE_NP, PRESSURE_OFL, True,
+     None),
+    ('windSpeed', '_WindSpeed', WIND_NP, WIND_OFL, True, None),
+    ('windGust', '_Gust', WIND_NP, WIND_OFL, True, None),
+    ('rainRate', '_Rain1H', RAIN_NP, RAIN_OFL, False, 10),  # weewx wants cm/hr
+    ]
+
+# fields of a LOOP packet for the observations derived by the console
+# the console has no absolute (station) pressure, so barometer is the same
+# relative pressure as pressure.  see derived_observations
+HARDWARE_LOOP_FIELDS = [
+    ('dewpoint', '_Dewpoint', TEMPERATURE_NP, TEMPERATURE_OFL, True, None),
+    ('windchill', '_Windchill', TEMPERATURE_NP, TEMPERATURE_OFL, True, None),
+    ('barometer', '_PressureRelative_hPa', PRESSURE_NP, PRESSURE_OFL, True,
+     None),
+    ]
+
+# the rain total is not put in the packet, but used for the rain since the
+# last packet
+LOOP_RAIN_FIELD = ('rain', '_RainTotal', RAIN_NP, RAIN_OFL, False, None)
+
+# CurrentData attributes of the current and previous wind and gust
+# directions, in the order of WIND_DIR_FIELDS
+WIND_DIR_ATTRS = (['_WindDirection'] +
+                  ['_WindDirection%d' % i for i in xrange(1, 6)] +
+                  ['_GustDirection'] +
+                  ['_GustDirection%d' % i for i in xrange(1, 6)])
+
+
+class PacketBuilder(object):
+    """Build LOOP packets from CurrentData.  The fields, their sentinels
+    and their scaling are resolved when the builder is created, into the
+    source of a function with one statement per field and no lookups or
+    loops, which is then compiled.  Use build(data, battery) to get the
+    packet for the observation data and the battery status nibble, and the
+    rain total, or None if it is not valid.  The rain in the packet is
+    left to the caller."""
+
+    def __init__(self, hardware_derived=False):
+        fields = list(LOOP_FIELDS)
+        if hardware_derived:
+            fields.extend(HARDWARE_LOOP_FIELDS)
+        self.source = PacketBuilder.generate(fields)
+        namespace = {'WIND_DIR_DEGREES': WIND_DIR_DEGREES,
+                     'BATTERY_PACKET_FIELDS': BATTERY_PACKET_FIELDS}
+        exec compile(self.source, '<PacketBuilder>', 'exec') in namespace
+        self.build = namespace['build']
+
+    @staticmethod
+    def generate(fields):
+        lines = ['def build(data, battery):',
+                 '    packet = {"usUnits": %d, "dateTime": data._timestamp}' %
+                 weewx.METRIC]
+        for (name, attr, np, ofl, fuzzy, divisor) in fields + [LOOP_RAIN_FIELD]:
+            lines.append('    v = data.%s' % attr)
+            if fuzzy:
+                lines.append('    if -0.001 < %r - v < 0.001 or'
+                             ' -0.001 < %r - v < 0.001:' % (np, ofl))
+            else:
+                lines.append('    if v == %r or v == %r:' % (np, ofl))
+            lines.append('        v = None')
+            if divisor is not None:
+                lines.append('    else:')
+                lines.append('        v /= %r' % divisor)
+            if name == LOOP_RAIN_FIELD[0]:
+                lines.append('    rain_total = v')
+            else:
+                lines.append('    packet[%r] = v' % name)
+        # the current direction is None when there is no wind, as with
+        # getWindDir.  the previous directions were recorded with their
+        # own speeds, which the console does not report, so they are
+        # reported whatever the current speed is.
+        lines.append('    t = WIND_DIR_DEGREES')
+        for speed, names, attrs in [
+            ('windSpeed', WIND_DIR_FIELDS[:6], WIND_DIR_ATTRS[:6]),
+            ('windGust', WIND_DIR_FIELDS[6:], WIND_DIR_ATTRS[6:])]:
+            lines.append('    if packet[%r]:' % speed)
+            lines.append('        packet[%r] = t[data.%s]' %
+                         (names[0], attrs[0]))
+            lines.append('    else:')
+            lines.append('        packet[%r] = None' % names[0])
+            for name, attr in zip(names[1:], attrs[1:]):
+                lines.append('    packet[%r] = t[data.%s]' % (name, attr))
+        lines.append('    packet.update(BATTERY_PACKET_FIELDS[battery & 0xF])')
+        lines.append('    return packet, rain_total')
+        return '\n'.join(lines) + '\n'
+
+
+def get_valid_observations(data, sentinels=OBSERVATION_SENTINELS):
+    """Check every observation against its sentinels in a single pass.
+    Returns a dict of attribute name to value, with None for any value that
+    is not present or outside factory limits."""
+    obs = dict()
+    for (attr, np, ofl, fuzzy) in sentinels:
+        v = getattr(data, attr)
+        if fuzzy:
+            if -0.001 < np - v < 0.001 or -0.001 < ofl - v < 0.001:
+                v = None
+        elif v == np or v == ofl:
+            v = None
+        obs[attr] = v
+    return obs
+
+
 class CWeatherTraits(object):
     windDirMap = {
         0: "N", 1: "NNE", 2: "NE", 3: "ENE", 4: "E", 5: "ESE", 6: "SE",
@@ -1820,59 +3305,52 @@ class CWeatherTraits(object):
     trendMap = {
         0: "Stable(Neutral)", 1: "Rising(Up)", 2: "Falling(Down)", 3: "Error" }
 
+    # these are retained for compatibility.  code in the decode paths should
+    # use the module-level constants directly.
 
     @staticmethod
     def TemperatureNP():
-        return 81.099998
-
+        return TEMPERATURE_NP
 
     @staticmethod
     def TemperatureOFL():
-        return 136.0
-
+        return TEMPERATURE_OFL
 
     @staticmethod
     def PressureNP():
-        return 10101010.0
-
+        return PRESSURE_NP
 
     @staticmethod
     def PressureOFL():
-        return 16666.5
-
+        return PRESSURE_OFL
 
     @staticmethod
     def HumidityNP():
-        return 110.0
-
+        return HUMIDITY_NP
 
     @staticmethod
     def HumidityOFL():
-        return 121.0
-
+        return HUMIDITY_OFL
 
     @staticmethod
     def RainNP():
-        return -0.2
-
+        return RAIN_NP
 
     @staticmethod
     def RainOFL():
-        return 16666.664
+        return RAIN_OFL
 
     @staticmethod
     def WindNP():
-        return 183.6 # km/h = 51.0 m/s
-
+        return WIND_NP
 
     @staticmethod
     def WindOFL():
-        return 183.96 # km/h = 51.099998 m/s
-
+        return WIND_OFL
 
     @staticmethod
     def TemperatureOffset():
-        return 40.0
+        return TEMPERATURE_OFFSET
 
 
 class CMeasurement:
@@ -2030,10 +3508,10 @@ class Decode(object):
         """read 7 nibbles, presentation with 3 decimals; units of mm"""
         if (Decode.isErr2(buf, start+0, StartOnHiNibble) or
             Decode.isErr5(buf, start+1, StartOnHiNibble)):
-            result = CWeatherTraits.RainNP()
+            result = RAIN_NP
         elif (Decode.isOFL2(buf, start+0, StartOnHiNibble) or
               Decode.isOFL5(buf, start+1, StartOnHiNibble)):
-            result = CWeatherTraits.RainOFL()
+            result = RAIN_OFL
         elif StartOnHiNibble:
             result  = (buf[0][start+0] >>  4)*  1000 \
                 + (buf[0][start+0] & 0xF)* 100    \
@@ -2058,11 +3536,11 @@ class Decode(object):
         if (Decode.isErr2(buf, start+0, StartOnHiNibble) or
             Decode.isErr2(buf, start+1, StartOnHiNibble) or
             Decode.isErr2(buf, start+2, StartOnHiNibble) ):
-            result = CWeatherTraits.RainNP()
+            result = RAIN_NP
         elif (Decode.isOFL2(buf, start+0, StartOnHiNibble) or
               Decode.isOFL2(buf, start+1, StartOnHiNibble) or
               Decode.isOFL2(buf, start+2, StartOnHiNibble)):
-            result = CWeatherTraits.RainOFL()
+            result = RAIN_OFL
         elif StartOnHiNibble:
             result  = (buf[0][start+0] >>  4)*  1000 \
                 + (buf[0][start+0] & 0xF)* 100   \
@@ -2089,9 +3567,9 @@ class Decode(object):
             hibyte = 16*(buf[0][start+0] & 0xF) + ((buf[0][start+1] >> 4) & 0xF)
             lobyte = buf[0][start+1] & 0xF            
         if hibyte == 0xFF and lobyte == 0xE :
-            result = CWeatherTraits.RainNP()
+            result = RAIN_NP
         elif hibyte == 0xFF and lobyte == 0xF :
-            result = CWeatherTraits.RainOFL()
+            result = RAIN_OFL
         else:
             val = Decode.toFloat_3_1(buf, start, StartOnHiNibble) # 0.1 inch
             result = val * 2.54 # mm
@@ -2145,9 +3623,9 @@ class Decode(object):
     def toHumidity_2_0(buf, start, StartOnHiNibble):
         """read 2 nibbles, presentation with 0 decimal"""
         if Decode.isErr2(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.HumidityNP()
+            result = HUMIDITY_NP
         elif Decode.isOFL2(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.HumidityOFL()
+            result = HUMIDITY_OFL
         else:
             result = Decode.toInt_2(buf, start, StartOnHiNibble)
         return result
@@ -2156,9 +3634,9 @@ class Decode(object):
     def toTemperature_5_3(buf, start, StartOnHiNibble):
         """read 5 nibbles, presentation with 3 decimals; units of degree C"""
         if Decode.isErr5(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.TemperatureNP()
+            result = TEMPERATURE_NP
         elif Decode.isOFL5(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.TemperatureOFL()
+            result = TEMPERATURE_OFL
         else:
             if StartOnHiNibble:
                 rawtemp = (buf[0][start+0] >>  4)* 10 \
@@ -2172,16 +3650,16 @@ class Decode(object):
                     + (buf[0][start+1] & 0xF)*  0.1   \
                     + (buf[0][start+2] >>  4)*  0.01  \
                     + (buf[0][start+2] & 0xF)*  0.001
-            result = rawtemp - CWeatherTraits.TemperatureOffset()
+            result = rawtemp - TEMPERATURE_OFFSET
         return result
 
     @staticmethod
     def toTemperature_3_1(buf, start, StartOnHiNibble):
         """read 3 nibbles, presentation with 1 decimal; units of degree C"""
         if Decode.isErr3(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.TemperatureNP()
+            result = TEMPERATURE_NP
         elif Decode.isOFL3(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.TemperatureOFL()
+            result = TEMPERATURE_OFL
         else:
             if StartOnHiNibble:
                 rawtemp   =  (buf[0][start+0] >>  4)*  10 \
@@ -2191,7 +3669,7 @@ class Decode(object):
                 rawtemp   =  (buf[0][start+0] & 0xF)*  10 \
                     +  (buf[0][start+1] >>  4)*  1   \
                     +  (buf[0][start+1] & 0xF)*  0.1 
-            result = rawtemp - CWeatherTraits.TemperatureOffset()
+            result = rawtemp - TEMPERATURE_OFFSET
         return result
 
     @staticmethod
@@ -2217,9 +3695,9 @@ class Decode(object):
             hibyte = 16*(buf[0][start+0] & 0xF) + ((buf[0][start+1] >> 4) & 0xF)
             lobyte = buf[0][start+1] & 0xF            
         if hibyte == 0xFF and lobyte == 0xE:
-            result = CWeatherTraits.WindNP()
+            result = WIND_NP
         elif hibyte == 0xFF and lobyte == 0xF:
-            result = CWeatherTraits.WindOFL()
+            result = WIND_OFL
         else:
             result = Decode.toFloat_3_1(buf, start, StartOnHiNibble) # m/s
             result *= 3.6 # km/h
@@ -2234,9 +3712,9 @@ class Decode(object):
     def toPressure_hPa_5_1(buf, start, StartOnHiNibble):
         """read 5 nibbles, presentation with 1 decimal; units of hPa (mbar)"""
         if Decode.isErr5(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.PressureNP()
+            result = PRESSURE_NP
         elif Decode.isOFL5(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.PressureOFL()
+            result = PRESSURE_OFL
         elif StartOnHiNibble :
             result = (buf[0][start+0] >> 4)* 1000 \
                 + (buf[0][start+0] & 0xF)* 100  \
@@ -2255,9 +3733,9 @@ class Decode(object):
     def toPressure_inHg_5_2(buf, start, StartOnHiNibble):
         """read 5 nibbles, presentation with 2 decimals; units of inHg"""
         if Decode.isErr5(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.PressureNP()
+            result = PRESSURE_NP
         elif Decode.isOFL5(buf, start+0, StartOnHiNibble):
-            result = CWeatherTraits.PressureOFL()
+            result = PRESSURE_OFL
         elif StartOnHiNibble:
             result = (buf[0][start+0] >> 4)* 100 \
                 + (buf[0][start+0] & 0xF)* 10   \
@@ -2275,21 +3753,42 @@ class Decode(object):
 
 class CurrentData(object):
 
+    # min/max measurements whose error, overflow, and timestamp are derived
+    # from the value.  each entry is (attribute, not-present value, overflow
+    # value, timestamps start on hi nibble, [(min/max, timestamp position,
+    # label)]).
+    _minmax_fields = [
+        ('_TempIndoorMinMax', TEMPERATURE_NP, TEMPERATURE_OFL, 0,
+         [('_Max', 9, 'TempIndoorMax'), ('_Min', 14, 'TempIndoorMin')]),
+        ('_TempOutdoorMinMax', TEMPERATURE_NP, TEMPERATURE_OFL, 0,
+         [('_Max', 27, 'TempOutdoorMax'), ('_Min', 32, 'TempOutdoorMin')]),
+        ('_WindchillMinMax', TEMPERATURE_NP, TEMPERATURE_OFL, 0,
+         [('_Max', 45, 'WindchillMax'), ('_Min', 50, 'WindchillMin')]),
+        ('_DewpointMinMax', TEMPERATURE_NP, TEMPERATURE_OFL, 0,
+         [('_Max', 63, 'DewpointMax'), ('_Min', 68, 'DewpointMin')]),
+        ('_HumidityIndoorMinMax', HUMIDITY_NP, HUMIDITY_OFL, 1,
+         [('_Max', 81, 'HumidityIndoorMax'), ('_Min', 86, 'HumidityIndoorMin')]),
+        ('_HumidityOutdoorMinMax', HUMIDITY_NP, HUMIDITY_OFL, 1,
+         [('_Max', 94, 'HumidityOutdoorMax'), ('_Min', 99, 'HumidityOutdoorMin')]),
+        ('_GustMax', WIND_NP, WIND_OFL, 1,
+         [('_Max', 179, 'GustMax')]),
+        ]
+
     def __init__(self):
         self._timestamp = None
         self._checksum = None
-        self._PressureRelative_hPa = CWeatherTraits.PressureNP()
+        self._PressureRelative_hPa = PRESSURE_NP
         self._PressureRelative_hPaMinMax = CMinMaxMeasurement()
-        self._PressureRelative_inHg = CWeatherTraits.PressureNP()
+        self._PressureRelative_inHg = PRESSURE_NP
         self._PressureRelative_inHgMinMax = CMinMaxMeasurement()
-        self._WindSpeed = CWeatherTraits.WindNP()
+        self._WindSpeed = WIND_NP
         self._WindDirection = EWindDirection.wdNone
         self._WindDirection1 = EWindDirection.wdNone
         self._WindDirection2 = EWindDirection.wdNone
         self._WindDirection3 = EWindDirection.wdNone
         self._WindDirection4 = EWindDirection.wdNone
         self._WindDirection5 = EWindDirection.wdNone
-        self._Gust = CWeatherTraits.WindNP()
+        self._Gust = WIND_NP
         self._GustMax = CMinMaxMeasurement()
         self._GustDirection = EWindDirection.wdNone
         self._GustDirection1 = EWindDirection.wdNone
@@ -2297,27 +3796,27 @@ class CurrentData(object):
         self._GustDirection3 = EWindDirection.wdNone
         self._GustDirection4 = EWindDirection.wdNone
         self._GustDirection5 = EWindDirection.wdNone
-        self._Rain1H = CWeatherTraits.RainNP()
+        self._Rain1H = RAIN_NP
         self._Rain1HMax = CMinMaxMeasurement()
-        self._Rain24H = CWeatherTraits.RainNP()
+        self._Rain24H = RAIN_NP
         self._Rain24HMax = CMinMaxMeasurement()
-        self._RainLastWeek = CWeatherTraits.RainNP()
+        self._RainLastWeek = RAIN_NP
         self._RainLastWeekMax = CMinMaxMeasurement()
-        self._RainLastMonth = CWeatherTraits.RainNP()
+        self._RainLastMonth = RAIN_NP
         self._RainLastMonthMax = CMinMaxMeasurement()
-        self._RainTotal = CWeatherTraits.RainNP()
+        self._RainTotal = RAIN_NP
         self._LastRainReset = None
-        self._TempIndoor = CWeatherTraits.TemperatureNP()
+        self._TempIndoor = TEMPERATURE_NP
         self._TempIndoorMinMax = CMinMaxMeasurement()
-        self._TempOutdoor = CWeatherTraits.TemperatureNP()
+        self._TempOutdoor = TEMPERATURE_NP
         self._TempOutdoorMinMax = CMinMaxMeasurement()
-        self._HumidityIndoor = CWeatherTraits.HumidityNP()
+        self._HumidityIndoor = HUMIDITY_NP
         self._HumidityIndoorMinMax = CMinMaxMeasurement()
-        self._HumidityOutdoor = CWeatherTraits.HumidityNP()
+        self._HumidityOutdoor = HUMIDITY_NP
         self._HumidityOutdoorMinMax = CMinMaxMeasurement()
-        self._Dewpoint = CWeatherTraits.TemperatureNP()
+        self._Dewpoint = TEMPERATURE_NP
         self._DewpointMinMax = CMinMaxMeasurement()
-        self._Windchill = CWeatherTraits.TemperatureNP()
+        self._Windchill = TEMPERATURE_NP
         self._WindchillMinMax = CMinMaxMeasurement()
         self._WeatherState = EWeatherState.WEATHER_ERR
         self._WeatherTendency = EWeatherTendency.TREND_ERR
@@ -2334,7 +3833,7 @@ class CurrentData(object):
         return self._checksum
 
     def read(self, buf):
-        self._timestamp = int(time.time() + 0.5)
+        self._timestamp = int(clock.time() + 0.5)
         if DEBUG_WEATHER_DATA > 1:
             logdbg('Read weather data; ts=%s' % self._timestamp)
         self._checksum = CurrentData.calcChecksum(buf)
@@ -2352,62 +3851,41 @@ class CurrentData(object):
         self._TempIndoorMinMax._Max._Value = Decode.toTemperature_5_3(nbuf, 19, 0)
         self._TempIndoorMinMax._Min._Value = Decode.toTemperature_5_3(nbuf, 22, 1)
         self._TempIndoor = Decode.toTemperature_5_3(nbuf, 24, 0)
-        self._TempIndoorMinMax._Min._IsError = (self._TempIndoorMinMax._Min._Value == CWeatherTraits.TemperatureNP())
-        self._TempIndoorMinMax._Min._IsOverflow = (self._TempIndoorMinMax._Min._Value == CWeatherTraits.TemperatureOFL())
-        self._TempIndoorMinMax._Max._IsError = (self._TempIndoorMinMax._Max._Value == CWeatherTraits.TemperatureNP())
-        self._TempIndoorMinMax._Max._IsOverflow = (self._TempIndoorMinMax._Max._Value == CWeatherTraits.TemperatureOFL())
-        self._TempIndoorMinMax._Max._Time = None if self._TempIndoorMinMax._Max._IsError or self._TempIndoorMinMax._Max._IsOverflow else Decode.toDateTime(nbuf, 9, 0, 'TempIndoorMax')
-        self._TempIndoorMinMax._Min._Time = None if self._TempIndoorMinMax._Min._IsError or self._TempIndoorMinMax._Min._IsOverflow else Decode.toDateTime(nbuf, 14, 0, 'TempIndoorMin')
 
         self._TempOutdoorMinMax._Max._Value = Decode.toTemperature_5_3(nbuf, 37, 0)
         self._TempOutdoorMinMax._Min._Value = Decode.toTemperature_5_3(nbuf, 40, 1)
         self._TempOutdoor = Decode.toTemperature_5_3(nbuf, 42, 0)
-        self._TempOutdoorMinMax._Min._IsError = (self._TempOutdoorMinMax._Min._Value == CWeatherTraits.TemperatureNP())
-        self._TempOutdoorMinMax._Min._IsOverflow = (self._TempOutdoorMinMax._Min._Value == CWeatherTraits.TemperatureOFL())
-        self._TempOutdoorMinMax._Max._IsError = (self._TempOutdoorMinMax._Max._Value == CWeatherTraits.TemperatureNP())
-        self._TempOutdoorMinMax._Max._IsOverflow = (self._TempOutdoorMinMax._Max._Value == CWeatherTraits.TemperatureOFL())
-        self._TempOutdoorMinMax._Max._Time = None if self._TempOutdoorMinMax._Max._IsError or self._TempOutdoorMinMax._Max._IsOverflow else Decode.toDateTime(nbuf, 27, 0, 'TempOutdoorMax')
-        self._TempOutdoorMinMax._Min._Time = None if self._TempOutdoorMinMax._Min._IsError or self._TempOutdoorMinMax._Min._IsOverflow else Decode.toDateTime(nbuf, 32, 0, 'TempOutdoorMin')
 
         self._WindchillMinMax._Max._Value = Decode.toTemperature_5_3(nbuf, 55, 0)
         self._WindchillMinMax._Min._Value = Decode.toTemperature_5_3(nbuf, 58, 1)
         self._Windchill = Decode.toTemperature_5_3(nbuf, 60, 0)
-        self._WindchillMinMax._Min._IsError = (self._WindchillMinMax._Min._Value == CWeatherTraits.TemperatureNP())
-        self._WindchillMinMax._Min._IsOverflow = (self._WindchillMinMax._Min._Value == CWeatherTraits.TemperatureOFL())
-        self._WindchillMinMax._Max._IsError = (self._WindchillMinMax._Max._Value == CWeatherTraits.TemperatureNP())
-        self._WindchillMinMax._Max._IsOverflow = (self._WindchillMinMax._Max._Value == CWeatherTraits.TemperatureOFL())
-        self._WindchillMinMax._Max._Time = None if self._WindchillMinMax._Max._IsError or self._WindchillMinMax._Max._IsOverflow else Decode.toDateTime(nbuf, 45, 0, 'WindchillMax')
-        self._WindchillMinMax._Min._Time = None if self._WindchillMinMax._Min._IsError or self._WindchillMinMax._Min._IsOverflow else Decode.toDateTime(nbuf, 50, 0, 'WindchillMin')
 
         self._DewpointMinMax._Max._Value = Decode.toTemperature_5_3(nbuf, 73, 0)
         self._DewpointMinMax._Min._Value = Decode.toTemperature_5_3(nbuf, 76, 1)
         self._Dewpoint = Decode.toTemperature_5_3(nbuf, 78, 0)
-        self._DewpointMinMax._Min._IsError = (self._DewpointMinMax._Min._Value == CWeatherTraits.TemperatureNP())
-        self._DewpointMinMax._Min._IsOverflow = (self._DewpointMinMax._Min._Value == CWeatherTraits.TemperatureOFL())
-        self._DewpointMinMax._Max._IsError = (self._DewpointMinMax._Max._Value == CWeatherTraits.TemperatureNP())
-        self._DewpointMinMax._Max._IsOverflow = (self._DewpointMinMax._Max._Value == CWeatherTraits.TemperatureOFL())
-        self._DewpointMinMax._Min._Time = None if self._DewpointMinMax._Min._IsError or self._DewpointMinMax._Min._IsOverflow else Decode.toDateTime(nbuf, 68, 0, 'DewpointMin')
-        self._DewpointMinMax._Max._Time = None if self._DewpointMinMax._Max._IsError or self._DewpointMinMax._Max._IsOverflow else Decode.toDateTime(nbuf, 63, 0, 'DewpointMax')
 
         self._HumidityIndoorMinMax._Max._Value = Decode.toHumidity_2_0(nbuf, 91, 1)
         self._HumidityIndoorMinMax._Min._Value = Decode.toHumidity_2_0(nbuf, 92, 1)
         self._HumidityIndoor = Decode.toHumidity_2_0(nbuf, 93, 1)
-        self._HumidityIndoorMinMax._Min._IsError = (self._HumidityIndoorMinMax._Min._Value == CWeatherTraits.HumidityNP())
-        self._HumidityIndoorMinMax._Min._IsOverflow = (self._HumidityIndoorMinMax._Min._Value == CWeatherTraits.HumidityOFL())
-        self._HumidityIndoorMinMax._Max._IsError = (self._HumidityIndoorMinMax._Max._Value == CWeatherTraits.HumidityNP())
-        self._HumidityIndoorMinMax._Max._IsOverflow = (self._HumidityIndoorMinMax._Max._Value == CWeatherTraits.HumidityOFL())
-        self._HumidityIndoorMinMax._Max._Time = None if self._HumidityIndoorMinMax._Max._IsError or self._HumidityIndoorMinMax._Max._IsOverflow else Decode.toDateTime(nbuf, 81, 1, 'HumidityIndoorMax')
-        self._HumidityIndoorMinMax._Min._Time = None if self._HumidityIndoorMinMax._Min._IsError or self._HumidityIndoorMinMax._Min._IsOverflow else Decode.toDateTime(nbuf, 86, 1, 'HumidityIndoorMin')
 
         self._HumidityOutdoorMinMax._Max._Value = Decode.toHumidity_2_0(nbuf, 104, 1)
         self._HumidityOutdoorMinMax._Min._Value = Decode.toHumidity_2_0(nbuf, 105, 1)
         self._HumidityOutdoor = Decode.toHumidity_2_0(nbuf, 106, 1)
-        self._HumidityOutdoorMinMax._Min._IsError = (self._HumidityOutdoorMinMax._Min._Value == CWeatherTraits.HumidityNP())
-        self._HumidityOutdoorMinMax._Min._IsOverflow = (self._HumidityOutdoorMinMax._Min._Value == CWeatherTraits.HumidityOFL())
-        self._HumidityOutdoorMinMax._Max._IsError = (self._HumidityOutdoorMinMax._Max._Value == CWeatherTraits.HumidityNP())
-        self._HumidityOutdoorMinMax._Max._IsOverflow = (self._HumidityOutdoorMinMax._Max._Value == CWeatherTraits.HumidityOFL())
-        self._HumidityOutdoorMinMax._Max._Time = None if self._HumidityOutdoorMinMax._Max._IsError or self._HumidityOutdoorMinMax._Max._IsOverflow else Decode.toDateTime(nbuf, 94, 1, 'HumidityOutdoorMax')
-        self._HumidityOutdoorMinMax._Min._Time = None if self._HumidityOutdoorMinMax._Min._IsError or self._HumidityOutdoorMinMax._Min._IsOverflow else Decode.toDateTime(nbuf, 99, 1, 'HumidityOutdoorMin')
+
+        self._GustMax._Max._Value = Decode.toWindspeed_6_2(nbuf, 184)
+
+        # flag error and overflow values then decode the timestamps of any
+        # valid min/max values, all in a single pass
+        for (attr, np, ofl, hi, times) in CurrentData._minmax_fields:
+            mm = getattr(self, attr)
+            for (m, start, label) in times:
+                m = getattr(mm, m)
+                m._IsError = (m._Value == np)
+                m._IsOverflow = (m._Value == ofl)
+                if m._IsError or m._IsOverflow:
+                    m._Time = None
+                else:
+                    m._Time = Decode.toDateTime(nbuf, start, hi, label)
 
         self._RainLastMonthMax._Max._Time = Decode.toDateTime(nbuf, 107, 1, 'RainLastMonthMax')
         self._RainLastMonthMax._Max._Value = Decode.toRain_6_2(nbuf, 112, 1)
@@ -2460,10 +3938,6 @@ class CurrentData(object):
         self._GustDirection4 = g4
         self._GustDirection5 = g5
 
-        self._GustMax._Max._Value = Decode.toWindspeed_6_2(nbuf, 184)
-        self._GustMax._Max._IsError = (self._GustMax._Max._Value == CWeatherTraits.WindNP())
-        self._GustMax._Max._IsOverflow = (self._GustMax._Max._Value == CWeatherTraits.WindOFL())
-        self._GustMax._Max._Time = None if self._GustMax._Max._IsError or self._GustMax._Max._IsOverflow else Decode.toDateTime(nbuf, 179, 1, 'GustMax')
         self._Gust = Decode.toWindspeed_6_2(nbuf, 187)
 
         # Apparently the station returns only ONE date time for both hPa/inHg
@@ -2531,6 +4005,11 @@ class StationConfig(object):
         self._GustMax = CMinMaxMeasurement()
         self._PressureRelative_hPaMinMax = CMinMaxMeasurement()
         self._PressureRelative_inHgMinMax = CMinMaxMeasurement()
+        # the encoded config is rebuilt only after read or a setter changed
+        # the config, otherwise testConfigChanged uses the cached image.
+        self._OutBuf = None
+        self._OutBufChanged = 0
+        self._dirty = True
 
     def setTemps(self, TempFormat, InTempLo, InTempHi, OutTempLo, OutTempHi):
         f1 = TempFormat
@@ -2551,6 +4030,7 @@ class StationConfig(object):
         self._TempIndoorMinMax._Max._Value = t2
         self._TempOutdoorMinMax._Min._Value = t3
         self._TempOutdoorMinMax._Max._Value = t4
+        self._dirty = True
         return 1     
     
     def setHums(self, InHumLo, InHumHi, OutHumLo, OutHumHi):
@@ -2566,6 +4046,7 @@ class StationConfig(object):
         self._HumidityIndoorMinMax._Max._Value = h2
         self._HumidityOutdoorMinMax._Min._Value = h3
         self._HumidityOutdoorMinMax._Max._Value = h4
+        self._dirty = True
         return 1
     
     def setRain24H(self, RainFormat, Rain24hHi):
@@ -2579,6 +4060,7 @@ class StationConfig(object):
             return 0
         self._RainFormat = f1
         self._Rain24HMax._Max._Value = r1
+        self._dirty = True
         return 1
     
     def setGust(self,WindSpeedFormat,GustHi):
@@ -2605,6 +4087,7 @@ class StationConfig(object):
             return 0 
         self._WindSpeedFormat = f1
         self._GustMax._Max._Value = int(g1)  # apparently gust value is always an integer
+        self._dirty = True
         return 1
     
     def setPresRels(self, PressureFormat, PresRelhPaLo, PresRelhPaHi, PresRelinHgLo, PresRelinHgHi):
@@ -2625,6 +4108,7 @@ class StationConfig(object):
         self._PressureRelative_hPaMinMax._Max._Value = p2
         self._PressureRelative_inHgMinMax._Min._Value = p3
         self._PressureRelative_inHgMinMax._Max._Value = p4
+        self._dirty = True
         return 1
     
     def getOutBufCS(self):
@@ -2636,6 +4120,7 @@ class StationConfig(object):
     def setResetMinMaxFlags(self, resetMinMaxFlags):
         logdbg('setResetMinMaxFlags: %s' % resetMinMaxFlags)
         self._ResetMinMaxFlags = resetMinMaxFlags
+        self._dirty = True
 
     def parseRain_3(self, number, buf, start, StartOnHiNibble, numbytes):
         '''Parse 7-digit number with 3 decimals'''
@@ -2781,10 +4266,28 @@ class StationConfig(object):
         # station will pause during an alarm and connection will be lost.
         self._WindDirAlarmFlags = 0x0000
         self._OtherAlarmFlags   = 0x0000
+        self._dirty = True
+
+    def testConfigChanged(self, buf=None):
+        """Return 1 if the config to be sent differs from the config in the
+        station.  If buf is specified, a copy of the encoded config is put
+        into buf[0].  The config is only encoded again when it has changed
+        since the last call."""
+        if self._dirty:
+            self._OutBufChanged = self.buildOutBuf()
+            self._dirty = False
+        if buf is not None:
+            buf[0] = list(self._OutBuf)
+        if self._OutBufChanged:
+            if DEBUG_CONFIG_DATA > 0:
+                logdbg('testConfigChanged: checksum or resetMinMaxFlags changed: OutBufCS=%04x InBufCS=%04x _ResetMinMaxFlags=%06x' % (self._OutBufCS, self._InBufCS, self._ResetMinMaxFlags))
+        elif DEBUG_CONFIG_DATA > 2:
+            logdbg('testConfigChanged: checksum not changed: OutBufCS=%04x' % self._OutBufCS)
+        return self._OutBufChanged
 
-    def testConfigChanged(self, buf):
+    def buildOutBuf(self):
         nbuf = [0]
-        nbuf[0] = buf[0]
+        nbuf[0] = [0]*44
         nbuf[0][0] = 16*(self._WindspeedFormat & 0xF) + 8*(self._RainFormat & 1) + 4*(self._PressureFormat & 1) + 2*(self._TemperatureFormat & 1) + (self._ClockMode & 1)
         nbuf[0][1] = self._WeatherThreshold & 0xF | 16 * self._StormThreshold & 0xF0
         nbuf[0][2] = self._LCDContrast & 0xF | 16 * self._LowBatFlags & 0xF0
@@ -2804,10 +4307,10 @@ class StationConfig(object):
         self.parse_0(self._HumidityOutdoorMinMax._Min._Value, nbuf, 26, 1, 2)
         self.parse_0(self._HumidityIndoorMinMax._Max._Value, nbuf, 27, 1, 2)
         self.parse_0(self._HumidityIndoorMinMax._Min._Value, nbuf, 28, 1, 2)
-        self.parse_3(self._TempOutdoorMinMax._Max._Value + CWeatherTraits.TemperatureOffset(), nbuf, 29, 1, 5)
-        self.parse_3(self._TempOutdoorMinMax._Min._Value + CWeatherTraits.TemperatureOffset(), nbuf, 31, 0, 5)
-        self.parse_3(self._TempIndoorMinMax._Max._Value + CWeatherTraits.TemperatureOffset(), nbuf, 34, 1, 5)
-        self.parse_3(self._TempIndoorMinMax._Min._Value + CWeatherTraits.TemperatureOffset(), nbuf, 36, 0, 5)
+        self.parse_3(self._TempOutdoorMinMax._Max._Value + TEMPERATURE_OFFSET, nbuf, 29, 1, 5)
+        self.parse_3(self._TempOutdoorMinMax._Min._Value + TEMPERATURE_OFFSET, nbuf, 31, 0, 5)
+        self.parse_3(self._TempIndoorMinMax._Max._Value + TEMPERATURE_OFFSET, nbuf, 34, 1, 5)
+        self.parse_3(self._TempIndoorMinMax._Min._Value + TEMPERATURE_OFFSET, nbuf, 36, 0, 5)
         # reverse buf to here
         Decode.reverseByteOrder(nbuf, 7, 32)
         # do not include the ResetMinMaxFlags bytes when calculating checksum
@@ -2817,14 +4320,10 @@ class StationConfig(object):
         self._OutBufCS = calc_checksum(nbuf, 0, end=39) + 7
         nbuf[0][42] = (self._OutBufCS >> 8) & 0xFF
         nbuf[0][43] = (self._OutBufCS >> 0) & 0xFF
-        buf[0] = nbuf[0]   
+        self._OutBuf = nbuf[0]
         if self._OutBufCS == self._InBufCS and self._ResetMinMaxFlags == 0:
-            if DEBUG_CONFIG_DATA > 2:
-                logdbg('testConfigChanged: checksum not changed: OutBufCS=%04x' % self._OutBufCS)
             changed = 0
         else:
-            if DEBUG_CONFIG_DATA > 0:
-                logdbg('testConfigChanged: checksum or resetMinMaxFlags changed: OutBufCS=%04x InBufCS=%04x _ResetMinMaxFlags=%06x' % (self._OutBufCS, self._InBufCS, self._ResetMinMaxFlags))
             if DEBUG_CONFIG_DATA > 1:
                 self.toLog()
             changed = 1
@@ -2910,15 +4409,15 @@ class HistoryData(object):
 
     def __init__(self):
         self.Time = None
-        self.TempIndoor = CWeatherTraits.TemperatureNP()
-        self.HumidityIndoor = CWeatherTraits.HumidityNP()
-        self.TempOutdoor = CWeatherTraits.TemperatureNP()
-        self.HumidityOutdoor = CWeatherTraits.HumidityNP()
+        self.TempIndoor = TEMPERATURE_NP
+        self.HumidityIndoor = HUMIDITY_NP
+        self.TempOutdoor = TEMPERATURE_NP
+        self.HumidityOutdoor = HUMIDITY_NP
         self.PressureRelative = None
         self.RainCounterRaw = 0
-        self.WindSpeed = CWeatherTraits.WindNP()
+        self.WindSpeed = WIND_NP
         self.WindDirection = EWindDirection.wdNone
-        self.Gust = CWeatherTraits.WindNP()
+        self.Gust = WIND_NP
         self.GustDirection = EWindDirection.wdNone
 
     def read(self, buf):
@@ -2950,8 +4449,17 @@ class HistoryData(object):
         logdbg("Gust:             %7.3f" % self.Gust)
         logdbg("GustDirection:    % 3s" % CWeatherTraits.windDirMap[self.GustDirection])
 
+    def getRainTotal(self):
+        """the rain counter in mm, or None if not present"""
+        return get_datum_match(self.RainCounterRaw, RAIN_NP, RAIN_OFL)
+
     def asDict(self):
-        """emit historical data as a dict with weewx conventions"""
+        """emit historical data as a dict with weewx conventions.  the rain
+        counter is cumulative, so 'rain' is None until the record has been
+        compared to the previous record using a RainCounter."""
+        rain_total = self.getRainTotal()
+        (wdir, gdir) = getWindDirs((self.WindDirection, self.GustDirection),
+                                   (self.WindSpeed, self.Gust))
         return {
             'dateTime': tstr_to_ts(str(self.Time)),
             'inTemp': self.TempIndoor,
@@ -2959,13 +4467,441 @@ class HistoryData(object):
             'outTemp': self.TempOutdoor,
             'outHumidity': self.HumidityOutdoor,
             'pressure': self.PressureRelative,
-            'rain': self.RainCounterRaw / 10,  # weewx wants cm
+            'rain': None,
+            'rainTotal': rain_total / 10 if rain_total is not None else None,
             'windSpeed': self.WindSpeed,
-            'windDir': getWindDir(self.WindDirection, self.WindSpeed),
+            'windDir': wdir,
             'windGust': self.Gust,
-            'windGustDir': getWindDir(self.GustDirection, self.Gust),
+            'windGustDir': gdir,
             }
 
+# the columns of a history export, with the same meaning as the keys of
+# HistoryData.asDict
+HISTORY_COLUMNS = ['dateTime', 'inTemp', 'inHumidity', 'outTemp',
+                   'outHumidity', 'pressure', 'rain', 'rainTotal',
+                   'windSpeed', 'windDir', 'windGust', 'windGustDir']
+
+# the rain total in a LOOP packet has 7 digits with 3 decimals, in mm
+LOOP_RAIN_MAX = 10000.0
+# the rain counter in a history record has 3 hex digits of 0.01 inch
+HISTORY_RAIN_MAX = 0x1000 * 0.254
+
+
+class CommIntervalController(object):
+    """Choose the communications mode interval from the weather.
+
+    The weather is active when it rains (Rain1H is not zero or the rain
+    total increases), when the gust is at least gust km/h, or when the gust
+    changes by at least gust_change km/h from one weather frame to the next.
+    The active interval is used as soon as the weather is active.  The calm
+    interval is used again only after the weather has been calm for hold
+    seconds, so that the interval does not flip back and forth."""
+
+    def __init__(self, active, calm, gust=30.0, gust_change=15.0, hold=900):
+        self.active = active
+        self.calm = calm
+        self.gust = gust
+        self.gust_change = gust_change
+        self.hold = hold
+        self.interval = calm
+        self.last_active_ts = None
+        self.last_gust = None
+        self.last_rain = None
+        self.num_changes = 0
+
+    def __str__(self):
+        return ('active=%s calm=%s gust=%s gust_change=%s hold=%s' %
+                (self.active, self.calm, self.gust, self.gust_change,
+                 self.hold))
+
+    def get_activity(self, data):
+        """Return the reason the weather is active, or None if calm."""
+        obs = get_valid_observations(data)
+        reason = None
+        gust = obs['_Gust']
+        rain = obs['_RainTotal']
+        if obs['_Rain1H']:
+            reason = 'rain rate %s' % obs['_Rain1H']
+        elif (rain is not None and self.last_rain is not None and
+              rain > self.last_rain):
+            reason = 'rain %s' % (rain - self.last_rain)
+        elif gust is not None and gust >= self.gust:
+            reason = 'gust %s' % gust
+        elif (gust is not None and self.last_gust is not None and
+              abs(gust - self.last_gust) >= self.gust_change):
+            reason = 'gust change %s' % abs(gust - self.last_gust)
+        if gust is not None:
+            self.last_gust = gust
+        if rain is not None:
+            self.last_rain = rain
+        return reason
+
+    def update(self, data, now):
+        """Return the interval to use after a weather frame at time now."""
+        reason = self.get_activity(data)
+        interval = self.interval
+        if reason is not None:
+            self.last_active_ts = now
+            interval = self.active
+        elif (self.last_active_ts is None or
+              now - self.last_active_ts >= self.hold):
+            interval = self.calm
+            reason = 'calm'
+        if interval != self.interval:
+            loginf('comm_interval changed from %s to %s: %s' %
+                   (self.interval, interval, reason))
+            self.interval = interval
+            self.num_changes += 1
+        return self.interval
+
+
+class RainCounter(object):
+    """Convert a cumulative station rain counter into the amount of rain
+    for each interval.
+
+    The amount for an interval is the difference from the previous reading.
+    A counter that decreases has either been reset or rolled over.  If the
+    console reports a new reset time, or if the drop is less than half of
+    the counter range, the counter was reset, so the new reading is the
+    amount.  Otherwise the counter rolled over at its maximum.
+
+    Readings with a timestamp older than the last reading are ignored, so
+    records that were already counted are never counted again.  All values
+    are in mm."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.last_total = None
+        self.last_reset = None
+        self.last_ts = None
+
+    def update(self, total, ts=None, reset=None):
+        """Return the amount since the previous reading, or None if it
+        cannot be determined."""
+        if total is None:
+            return None
+        if ts is not None and self.last_ts is not None and ts < self.last_ts:
+            return None
+        delta = None
+        if self.last_total is not None:
+            if (reset is not None and self.last_reset is not None and
+                reset != self.last_reset):
+                logdbg('rain counter reset at %s' % reset)
+                delta = total
+            elif total >= self.last_total:
+                delta = total - self.last_total
+            elif self.last_total - total > self.maximum / 2:
+                logdbg('rain counter rolled over: %s -> %s' %
+                       (self.last_total, total))
+                delta = total + self.maximum - self.last_total
+            else:
+                logdbg('rain counter reset: %s -> %s' %
+                       (self.last_total, total))
+                delta = total
+        self.last_total = total
+        if reset is not None:
+            self.last_reset = reset
+        if ts is not None:
+            self.last_ts = ts
+        return delta
+
+    def to_dict(self):
+        return {'total': self.last_total, 'ts': self.last_ts}
+
+    def from_dict(self, d):
+        self.last_total = d.get('total')
+        self.last_ts = d.get('ts')
+
+
+def get_history_exporter(filename, fmt=None):
+    """Return an exporter for the indicated format.  If no format is given,
+    files ending with .csv get CSV, everything else gets binary columns."""
+    if fmt is None:
+        fmt = 'csv' if filename.lower().endswith('.csv') else 'binary'
+    if fmt == 'csv':
+        return CSVHistoryExporter(filename)
+    elif fmt == 'binary':
+        return BinaryHistoryExporter(filename)
+    raise ValueError("unknown export format '%s'" % fmt)
+
+
+class HistoryExporter(object):
+    """Base class for appending history records to a file.  Records are
+    written in timestamp order, and records that are not newer than the
+    last record in the file are skipped, so that repeated exports of
+    overlapping history only add new rows."""
+
+    columns = HISTORY_COLUMNS
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def check(self):
+        """Make sure that the file can be appended to.  Raise ValueError
+        if it cannot."""
+        pass
+
+    def get_last_timestamp(self):
+        raise NotImplementedError
+
+    def append(self, records):
+        """Append the records, return the number of records written."""
+        self.check()
+        last_ts = self.get_last_timestamp()
+        recs = [r for r in records if r.get('dateTime') is not None and
+                (last_ts is None or r['dateTime'] > last_ts)]
+        recs.sort(key=lambda r: r['dateTime'])
+        if recs:
+            self.write(recs)
+        return len(recs)
+
+    def write(self, records):
+        raise NotImplementedError
+
+
+class CSVHistoryExporter(HistoryExporter):
+    """One row per record, with a header row.  Empty fields are None."""
+
+    def check(self):
+        """Refuse to append to a file with different columns, for example
+        one written before rainTotal was added."""
+        if not os.path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        try:
+            header = f.readline().strip()
+        finally:
+            f.close()
+        if header and header != ','.join(self.columns):
+            raise ValueError('the columns in the file are not %s; '
+                             'export to a new file' % ','.join(self.columns))
+
+    def get_last_timestamp(self):
+        if not os.path.exists(self.filename):
+            return None
+        f = open(self.filename, 'rb')
+        try:
+            # only the tail of the file is needed for the last row
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 1024))
+            lines = [x for x in f.read().splitlines() if x.strip()]
+        finally:
+            f.close()
+        if not lines:
+            return None
+        try:
+            return int(lines[-1].split(',')[0])
+        except ValueError:
+            return None  # only the header row
+
+    def write(self, records):
+        exists = os.path.exists(self.filename)
+        f = open(self.filename, 'ab')
+        try:
+            if not exists:
+                f.write(','.join(self.columns) + '\n')
+            for r in records:
+                f.write(','.join(['' if r.get(k) is None else str(r[k])
+                                  for k in self.columns]) + '\n')
+        finally:
+            f.close()
+
+
+class BinaryHistoryExporter(HistoryExporter):
+    """A directory with one file per column.  Each file is a sequence of
+    little-endian 8-byte floats, one per record, with NaN for None, so
+    appending a record means appending 8 bytes to each file and any column
+    can be loaded without reading the others."""
+
+    typecode = 'd'
+    itemsize = 8
+
+    def _column_file(self, name):
+        return os.path.join(self.filename, '%s.f64' % name)
+
+    def check(self):
+        """Refuse to append to a directory with different columns, for
+        example one written before rainTotal was added.  If an earlier
+        write failed part way through, the columns have different lengths.
+        Truncate them all to the shortest so that the rows line up again."""
+        if os.path.isdir(self.filename):
+            names = set([x[:-4] for x in os.listdir(self.filename)
+                         if x.endswith('.f64')])
+            if names and names != set(self.columns):
+                raise ValueError('the columns in the directory are not %s; '
+                                 'export to a new directory' %
+                                 ','.join(self.columns))
+        sizes = dict()
+        for k in self.columns:
+            fn = self._column_file(k)
+            if os.path.exists(fn):
+                sizes[fn] = os.path.getsize(fn)
+        if not sizes:
+            return
+        n = min(sizes.values()) // self.itemsize * self.itemsize
+        for fn in sizes:
+            if sizes[fn] != n:
+                logerr('truncate %s from %d to %d bytes' % (fn, sizes[fn], n))
+                f = open(fn, 'r+b')
+                try:
+                    f.truncate(n)
+                finally:
+                    f.close()
+
+    def get_last_timestamp(self):
+        fn = self._column_file('dateTime')
+        if not os.path.exists(fn):
+            return None
+        f = open(fn, 'rb')
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < self.itemsize:
+                return None
+            f.seek(-self.itemsize, os.SEEK_END)
+            a = array.array(self.typecode)
+            a.fromfile(f, 1)
+        finally:
+            f.close()
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return int(a[0])
+
+    def write(self, records):
+        if not os.path.isdir(self.filename):
+            os.makedirs(self.filename)
+        nan = float('nan')
+        for k in self.columns:
+            a = array.array(self.typecode,
+                            [nan if r.get(k) is None else r[k]
+                             for r in records])
+            if sys.byteorder == 'big':
+                a.byteswap()
+            f = open(self._column_file(k), 'ab')
+            try:
+                a.tofile(f)
+            finally:
+                f.close()
+
+
+class HistoryProcessor(object):
+    """Clean up history records in a single pass, in the order in which
+    they were read from the console.
+
+    One record is held back until the next record arrives.  That is
+    enough to deal with the problems the console produces:
+
+    - duplicates: consecutive records with the same timestamp.  The later
+      record replaces the earlier one.
+    - records ahead of time: when the time is set near the hour, the
+      console may write an extra record with a timestamp one history
+      period ahead.  The next record then has an earlier timestamp, so the
+      held-back record is dropped.  A last record in the future is dropped
+      too.
+    - stale records: records that are not newer than the last emitted
+      record are dropped.
+    - gaps: a jump of more than one and a half intervals is logged, and
+      the record gets the nominal interval.
+
+    Rain from a dropped or replaced record is added to the record that
+    takes its place, so no rain is lost.
+
+    interval: the nominal history interval in minutes, or None if unknown
+    last_ts: the timestamp of the last record already processed, if any"""
+
+    def __init__(self, interval=None, last_ts=None):
+        self.interval = interval
+        self.last_ts = last_ts if last_ts else None
+        self.pending = None
+        self.num_duplicate = 0
+        self.num_dropped = 0
+        self.num_gaps = 0
+
+    def process(self, records):
+        """Generator that yields the cleaned up records."""
+        for r in records:
+            for x in self.add(r):
+                yield x
+        for x in self.flush():
+            yield x
+
+    def add(self, record):
+        """Add a record, return a list of records that are ready."""
+        ts = record.get('dateTime')
+        if ts is None or (self.last_ts is not None and ts <= self.last_ts):
+            if ts is not None and DEBUG_HISTORY_DATA > 0:
+                logdbg('HistoryProcessor: skip stale record %s' %
+                       weeutil.weeutil.timestamp_to_string(ts))
+            self.num_dropped += 1
+            return []
+        if self.pending is None:
+            self.pending = record
+            return []
+        pending_ts = self.pending['dateTime']
+        if ts == pending_ts:
+            if DEBUG_HISTORY_DATA > 0:
+                logdbg('HistoryProcessor: replace record with duplicate'
+                       ' timestamp %s' % weeutil.weeutil.timestamp_to_string(ts))
+            self.num_duplicate += 1
+            self._replace(record)
+            return []
+        if ts < pending_ts:
+            loginf('HistoryProcessor: drop record at %s that is ahead of %s' %
+                   (weeutil.weeutil.timestamp_to_string(pending_ts),
+                    weeutil.weeutil.timestamp_to_string(ts)))
+            self.num_dropped += 1
+            self._replace(record)
+            return []
+        ready = self._emit()
+        self.pending = record
+        return ready
+
+    def flush(self, now=None):
+        """Return the held-back record, unless it is in the future."""
+        if self.pending is None:
+            return []
+        if now is None:
+            now = clock.time()
+        if self.pending['dateTime'] > now + 60:
+            loginf('HistoryProcessor: drop record in the future at %s' %
+                   weeutil.weeutil.timestamp_to_string(
+                       self.pending['dateTime']))
+            self.num_dropped += 1
+            self.pending = None
+            return []
+        return self._emit()
+
+    def _replace(self, record):
+        rain = self.pending.get('rain')
+        if rain is not None:
+            if record.get('rain') is None:
+                record['rain'] = rain
+            else:
+                record['rain'] += rain
+        self.pending = record
+
+    def _emit(self):
+        r = self.pending
+        self.pending = None
+        ts = r['dateTime']
+        if self.last_ts is None:
+            interval = self.interval
+        else:
+            interval = (ts - self.last_ts) / 60
+            if (self.interval is not None and
+                ts - self.last_ts > 90 * self.interval):
+                loginf('HistoryProcessor: gap of %d minutes before %s' %
+                       (interval, weeutil.weeutil.timestamp_to_string(ts)))
+                self.num_gaps += 1
+                interval = self.interval
+        self.last_ts = ts
+        if interval is None:
+            # without a known interval the record cannot be used
+            self.num_dropped += 1
+            return []
+        r['interval'] = interval
+        return [r]
+
+
 class HistoryCache:
     def __init__(self):
         self.wait_at_start = 1
@@ -2978,7 +4914,6 @@ class HistoryCache:
         self.records = []
         self.num_outstanding_records = None
         self.num_scanned = 0
-        self.last_ts = 0
 
 
 class TransceiverSettings(object):
@@ -2997,6 +4932,8 @@ class LastStat(object):
         self.last_weather_ts = 0
         self.last_history_ts = 0
         self.last_config_ts = 0
+        # monotonic time of the last frame of each kind, for ages
+        self.mono = dict()
 
     def update(self, seen_ts=None,
                          quality=None, battery=None,
@@ -3006,18 +4943,30 @@ class LastStat(object):
         if DEBUG_COMM > 1:
             logdbg('update: seen=%s quality=%s battery=%s weather=%s history=%s config=%s' %
                    (seen_ts, quality, battery, weather_ts, history_ts, config_ts))
+        mono = clock.monotonic()
         if seen_ts is not None:
             self.last_seen_ts = seen_ts
+            self.mono['seen'] = mono
         if quality is not None:
             self.LastLinkQuality = quality
         if battery is not None:
             self.LastBatteryStatus = battery
         if weather_ts is not None:
             self.last_weather_ts = weather_ts
+            self.mono['weather'] = mono
         if history_ts is not None:
             self.last_history_ts = history_ts
+            self.mono['history'] = mono
         if config_ts is not None:
             self.last_config_ts = config_ts
+            self.mono['config'] = mono
+
+    def age(self, kind):
+        """Seconds since the last frame of the indicated kind, one of seen,
+        weather, history or config, or None if there was none."""
+        if kind not in self.mono:
+            return None
+        return clock.monotonic() - self.mono[kind]
 
 
 class Transceiver(object):
@@ -3271,6 +5220,21 @@ class Transceiver(object):
                              index=0x0000000,
                              timeout=self.timeout)
 
+    def waitForState(self, timeout=1.0, interval=0.05, minwait=0.1):
+        """Wait until the transceiver state is no longer intermediate and
+        has been the same for two polls, at most timeout seconds.  Return
+        the time waited."""
+        t0 = clock.monotonic()
+        time.sleep(minwait)
+        last = None
+        while clock.monotonic() - t0 < timeout:
+            state = self.getState()
+            if state[0] != 0x14 and state == last:
+                break
+            last = state
+            time.sleep(interval)
+        return clock.monotonic() - t0
+
     def execute(self, command):
         buf = [0]*0x0f #*0x15
         buf[0] = 0xd9
@@ -3367,6 +5331,174 @@ class Transceiver(object):
                 addr += 16
         return new_data
 
+
+# kinds of USB errors.  timeouts and stalls (broken pipe) are usually
+# transient, for example on a busy or flaky hub, and the operation can be
+# retried.  no_device means that the transceiver went away, so it must be
+# found again on the bus.
+USB_ERROR_TIMEOUT = 'timeout'
+USB_ERROR_PIPE = 'pipe'
+USB_ERROR_NO_DEVICE = 'no_device'
+USB_ERROR_OTHER = 'other'
+
+# errno and libusb-1.0 error codes for each kind of error
+USB_ERROR_CODES = {
+    USB_ERROR_TIMEOUT: [110, -7],  # ETIMEDOUT, LIBUSB_ERROR_TIMEOUT
+    USB_ERROR_PIPE: [32, -9],  # EPIPE, LIBUSB_ERROR_PIPE
+    USB_ERROR_NO_DEVICE: [19, -4]}  # ENODEV, LIBUSB_ERROR_NO_DEVICE
+
+# fragments of the error messages of libusb-0.1 and pyusb for each kind
+USB_ERROR_MESSAGES = {
+    USB_ERROR_TIMEOUT: ['timed out', 'timeout'],
+    USB_ERROR_PIPE: ['broken pipe', 'pipe error'],
+    USB_ERROR_NO_DEVICE: ['no such device', 'no device', 'not open']}
+
+
+def classify_usb_error(e):
+    """Return the kind of a USB error, one of USB_ERROR_TIMEOUT,
+    USB_ERROR_PIPE, USB_ERROR_NO_DEVICE or USB_ERROR_OTHER."""
+    codes = [getattr(e, 'errno', None), getattr(e, 'backend_error_code', None)]
+    for kind in [USB_ERROR_TIMEOUT, USB_ERROR_PIPE, USB_ERROR_NO_DEVICE]:
+        for code in codes:
+            if code is not None and code in USB_ERROR_CODES[kind]:
+                return kind
+    msg = str(e).lower()
+    for kind in [USB_ERROR_TIMEOUT, USB_ERROR_PIPE, USB_ERROR_NO_DEVICE]:
+        for frag in USB_ERROR_MESSAGES[kind]:
+            if frag in msg:
+                return kind
+    return USB_ERROR_OTHER
+
+
+class USBTransport(object):
+    """Wrapper around a Transceiver that retries failed USB operations.
+
+    Timeouts and stalls of the operations that only read the state of the
+    transceiver are retried up to retries times, with a delay that doubles
+    after each attempt and is randomized by +/-50% so that retries do not
+    fall into step with whatever is upsetting the bus.  Operations that
+    exchange frames with the console are not retried: the console waits
+    only a few milliseconds for a response, so a retry would miss the
+    window anyway.  Other errors are raised immediately.  If the device
+    went away, reconnect finds it again by vendor, product and serial
+    number once it is plugged back in.
+
+    Any other attribute is that of the wrapped Transceiver."""
+
+    # methods of Transceiver that talk to the device
+    IO_METHODS = ['setTX', 'setRX', 'getState', 'readConfigFlash', 'setState',
+                  'setFrame', 'getFrame', 'writeReg', 'waitForState',
+                  'execute', 'setPreamblePattern']
+    # methods that can be retried without changing what the device does
+    RETRY_METHODS = ['getState', 'waitForState', 'readConfigFlash']
+
+    def __init__(self, transceiver=None, retries=3, backoff=0.01,
+                 max_backoff=0.5, reconnect_timeout=60):
+        self.transceiver = transceiver or Transceiver()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reconnect_timeout = reconnect_timeout
+        self.usb_args = None
+        self.error_counts = {USB_ERROR_TIMEOUT: 0, USB_ERROR_PIPE: 0,
+                             USB_ERROR_NO_DEVICE: 0, USB_ERROR_OTHER: 0}
+        self.num_retries = 0
+        self.num_recovered = 0
+        self.num_failed = 0
+        self.num_reconnects = 0
+
+    def __getattr__(self, name):
+        if name == 'transceiver':
+            raise AttributeError(name)
+        attr = getattr(self.transceiver, name)
+        if name in USBTransport.IO_METHODS:
+            return lambda *args, **kwargs: self.call(name, attr,
+                                                     *args, **kwargs)
+        return attr
+
+    def open(self, vid, pid, serial):
+        self.usb_args = (vid, pid, serial)
+        self.transceiver.open(vid, pid, serial)
+
+    def close(self):
+        try:
+            self.transceiver.close()
+        except usb.USBError, e:
+            logdbg('close failed: %s' % e)
+        self.transceiver.devh = None
+
+    def delay(self, attempt):
+        """Return the delay before retry number attempt, with jitter."""
+        d = min(self.backoff * (1 << attempt), self.max_backoff)
+        return d * random.uniform(0.5, 1.5)
+
+    def call(self, name, func, *args, **kwargs):
+        if self.transceiver.devh is None:
+            self.error_counts[USB_ERROR_NO_DEVICE] += 1
+            self.num_failed += 1
+            raise usb.USBError('%s: transceiver is not open' % name)
+        retries = self.retries if name in USBTransport.RETRY_METHODS else 0
+        attempt = 0
+        while True:
+            try:
+                result = func(*args, **kwargs)
+                if attempt:
+                    self.num_recovered += 1
+                    logdbg('%s succeeded after %d retries' % (name, attempt))
+                return result
+            except usb.USBError, e:
+                kind = classify_usb_error(e)
+                self.error_counts[kind] += 1
+                if (kind not in [USB_ERROR_TIMEOUT, USB_ERROR_PIPE] or
+                    attempt >= retries):
+                    self.num_failed += 1
+                    logerr('%s failed (%s): %s' % (name, kind, e))
+                    raise
+                d = self.delay(attempt)
+                if DEBUG_COMM > 0:
+                    logdbg('%s failed (%s): %s; retry in %.3f s' %
+                           (name, kind, e, d))
+                attempt += 1
+                self.num_retries += 1
+                time.sleep(d)
+
+    def reconnect(self):
+        """Close the device, then find it again on the bus by vendor,
+        product and serial number and open it.  Wait up to
+        reconnect_timeout seconds for the device to show up, for example
+        after it was unplugged."""
+        self.close()
+        end = clock.monotonic() + self.reconnect_timeout
+        attempt = 0
+        while True:
+            try:
+                device = Transceiver._find_device(*self.usb_args)
+                if device is not None:
+                    self.transceiver.devh = Transceiver._open_device(device)
+                    self.num_reconnects += 1
+                    loginf('reconnected to transceiver after %d attempts' %
+                           (attempt + 1))
+                    return
+            except (usb.USBError, weewx.WeeWxIOError), e:
+                logdbg('reconnect failed: %s' % e)
+            d = self.delay(attempt)
+            if clock.monotonic() + d > end:
+                break
+            attempt += 1
+            time.sleep(d)
+        vid, pid, serial = self.usb_args
+        logcrt('Cannot find USB device with Vendor=0x%04x ProdID=0x%04x Serial=%s' %
+               (vid, pid, serial))
+        raise weewx.WeeWxIOError('Unable to find transceiver on USB')
+
+    def getStats(self):
+        return {'errors': dict(self.error_counts),
+                'retries': self.num_retries,
+                'recovered': self.num_recovered,
+                'failed': self.num_failed,
+                'reconnects': self.num_reconnects}
+
+
 class AX5051RegisterNames:
     REVISION         = 0x0
     SCRATCH          = 0x1
@@ -3435,6 +5567,256 @@ class AX5051RegisterNames:
     RXMISC           = 0x7D
 
 
+class FrameRecorder(object):
+    """Bounded record of the most recent frames exchanged with the console,
+    with the time of each frame and the outcome of handling it.  Recording
+    a frame keeps a copy of its bytes and nothing else, so this is always
+    on.  When something goes wrong, dump writes the record to a file in
+    dump_dir, at most once every dump_interval seconds.  Only the newest
+    max_dumps files are kept.
+
+    The file is written by a separate thread, so that the RF thread does
+    not miss the console while waiting for the disk.  It is created with
+    O_EXCL and O_NOFOLLOW, so an existing file or a link planted in a
+    shared directory such as /var/tmp is never written through."""
+
+    prefix = 'ws28xx-frames-'
+
+    def __init__(self, size=64, dump_dir=None, dump_interval=300,
+                 max_dumps=10):
+        self.frames = collections.deque(maxlen=size)
+        self.dump_dir = dump_dir
+        self.dump_interval = dump_interval
+        self.max_dumps = max_dumps
+        self.last_dump_ts = None
+        self.num_dumps = 0
+
+    def record(self, direction, buf, length, outcome=None):
+        """Record a frame.  Return the entry, so that the outcome can be
+        filled in once it is known."""
+        entry = [clock.time(), direction, buf[:length], outcome]
+        self.frames.append(entry)
+        return entry
+
+    def dump(self, reason):
+        """Start writing the recorded frames to a file.  Return the file
+        name, or None if nothing will be written."""
+        if self.dump_dir is None:
+            return None
+        now = clock.monotonic()
+        if (self.last_dump_ts is not None and
+            now - self.last_dump_ts < self.dump_interval):
+            logdbg('skip frame dump for %s' % reason)
+            return None
+        self.last_dump_ts = now
+        ts = clock.time()
+        fn = os.path.join(self.dump_dir, '%s%s.txt' % (
+            self.prefix, time.strftime('%Y%m%d-%H%M%S', time.localtime(ts))))
+        # copy the frames now; the outcome of the last one may still change
+        frames = [list(x) for x in self.frames]
+        t = threading.Thread(target=self.write, args=(fn, ts, reason, frames))
+        t.setName('WS28xxFrameDump')
+        t.setDaemon(True)
+        t.start()
+        return fn
+
+    def write(self, fn, ts, reason, frames):
+        flags = (os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            f = os.fdopen(os.open(fn, flags, 0644), 'w')
+            try:
+                f.write('# %s: %s\n' % (
+                    weeutil.weeutil.timestamp_to_string(ts), reason))
+                for (t, direction, frame, outcome) in frames:
+                    f.write('%.3f %s %s %s\n' % (
+                        t, direction, outcome,
+                        ' '.join(['%02x' % x for x in frame])))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logerr('cannot write frame dump %s: %s' % (fn, e))
+            return
+        self.num_dumps += 1
+        loginf('%s: wrote %d frames to %s' % (reason, len(frames), fn))
+        self.remove_old_dumps()
+
+    def remove_old_dumps(self):
+        try:
+            names = sorted([x for x in os.listdir(self.dump_dir)
+                            if x.startswith(self.prefix) and
+                            x.endswith('.txt')])
+            for x in names[:-self.max_dumps]:
+                os.unlink(os.path.join(self.dump_dir, x))
+        except OSError, e:
+            logerr('cannot remove old frame dumps: %s' % e)
+
+
+class SamplingProfiler(object):
+    """Find out where the named threads spend their time by looking at
+    their call stacks every interval seconds for duration seconds.  This
+    needs no changes to the threads being sampled, so it can be used while
+    the driver is running, but it is not free: each sample holds the GIL
+    while it walks the stacks, about 20 microseconds on a PC and several
+    times that on a Raspberry Pi, and waking up every interval makes the
+    other threads give up the GIL more often.  When the RF thread runs in
+    the weewx process it can miss response windows while it is profiled
+    (see missed_windows in the RF statistics).  Use a longer interval, or
+    rf_process, where that matters.
+
+    The result is written to a file in dump_dir, either as collapsed
+    stacks (one line per distinct stack, with the frames separated by ';'
+    and followed by the number of samples, as used by flame graph tools)
+    or as a file that can be loaded with pstats.  In the pstats file the
+    times are estimated from the number of samples and the call counts
+    are the number of samples in which a function appears."""
+
+    formats = ['collapsed', 'pstats']
+
+    def __init__(self, threads, duration=60, interval=0.05,
+                 dump_dir='/var/tmp', fmt='collapsed'):
+        if fmt not in self.formats:
+            raise ValueError('unknown profile format %s' % fmt)
+        self.threads = threads
+        self.duration = duration
+        self.interval = interval
+        self.dump_dir = dump_dir
+        self.fmt = fmt
+        self.stacks = dict()
+        self.num_samples = 0
+        self.path = None
+        self.running = False
+        self.child = None
+
+    def start(self):
+        """Start sampling.  Return the name of the file to which the
+        result will be written."""
+        if self.running:
+            return self.path
+        ext = 'txt' if self.fmt == 'collapsed' else 'pstats'
+        self.path = os.path.join(self.dump_dir, 'ws28xx-profile-%s-%d.%s' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(clock.time())),
+            os.getpid(), ext))
+        self.stacks = dict()
+        self.num_samples = 0
+        self.running = True
+        self.child = threading.Thread(target=self.run)
+        self.child.setName('WS28xxProfiler')
+        self.child.setDaemon(True)
+        self.child.start()
+        loginf('profiling threads %s for %s seconds' %
+               (', '.join(self.threads), self.duration))
+        return self.path
+
+    def stop(self):
+        self.running = False
+        if self.child is not None:
+            self.child.join(5)
+            self.child = None
+
+    def run(self):
+        idents = dict()
+        for t in threading.enumerate():
+            if t.getName() in self.threads:
+                idents[t.ident] = t.getName()
+        if not idents:
+            logerr('profile: no thread named %s' % ', '.join(self.threads))
+            self.running = False
+            return
+        end = clock.monotonic() + self.duration
+        try:
+            while self.running and clock.monotonic() < end:
+                frames = sys._current_frames()
+                for ident in idents:
+                    f = frames.get(ident)
+                    if f is not None:
+                        self.add_sample(idents[ident], f)
+                del frames
+                self.num_samples += 1
+                time.sleep(self.interval)
+            self.write()
+        except Exception, e:
+            logerr('exception while profiling: %s' % e)
+            log_traceback(dst=syslog.LOG_INFO)
+        self.running = False
+
+    def add_sample(self, name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno,
+                          code.co_name))
+            frame = frame.f_back
+        stack.append(('~', 0, name))
+        stack.reverse()
+        stack = tuple(stack)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self):
+        if self.fmt == 'collapsed':
+            data = self.get_collapsed()
+        else:
+            data = marshal.dumps(self.get_stats())
+        flags = (os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            f = os.fdopen(os.open(self.path, flags, 0644), 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logerr('cannot write profile %s: %s' % (self.path, e))
+            return
+        loginf('wrote profile of %d samples to %s' %
+               (self.num_samples, self.path))
+
+    @staticmethod
+    def label(func):
+        if func[0] == '~':
+            return func[2]
+        return '%s (%s:%d)' % (func[2], os.path.basename(func[0]), func[1])
+
+    def get_collapsed(self):
+        lines = []
+        for stack, count in self.stacks.iteritems():
+            lines.append('%s %d\n' % (
+                ';'.join([self.label(x) for x in stack]), count))
+        lines.sort()
+        return ''.join(lines)
+
+    def get_stats(self):
+        """Convert the samples to the dictionary of (cc, nc, tt, ct,
+        callers) tuples that pstats expects, keyed by (file, line, name)."""
+        stats = dict()
+        for stack, count in self.stacks.iteritems():
+            dt = count * self.interval
+            seen = set()
+            caller = None
+            for func in stack[1:]:
+                if func not in stats:
+                    stats[func] = [0, 0, 0.0, 0.0, dict()]
+                st = stats[func]
+                if func not in seen:
+                    seen.add(func)
+                    st[0] += count
+                    st[1] += count
+                    st[3] += dt
+                if caller is not None:
+                    st[4][caller] = st[4].get(caller, 0) + count
+                caller = func
+            if caller is not None:
+                stats[caller][2] += dt
+        for func in stats:
+            stats[func] = tuple(stats[func])
+        return stats
+
+
+# ways to recover communication with the transceiver, from least to most
+# disruptive.  see CommunicationService.doRecovery
+RECOVERY_TIERS = ['rx', 'reset', 'reopen']
+
+
 class CommunicationService(object):
 
     def __init__(self, first_sleep):
@@ -3442,7 +5824,7 @@ class CommunicationService(object):
 
         self.first_sleep = first_sleep
         self.reg_names = dict()
-        self.hid = Transceiver()
+        self.hid = USBTransport()
         self.transceiver_settings = TransceiverSettings()
         self.last_stat = LastStat()
         self.station_config = StationConfig()
@@ -3459,12 +5841,41 @@ class CommunicationService(object):
         self.running = False
         self.child = None
         self.thread_wait = 60.0 # seconds
+        self.error = None  # why the RF thread stopped, if it failed
+        self.max_usb_failures = 3  # give up after this many in a row
+        self.usb_failures = 0
 
         self.command = None
         self.history_cache = HistoryCache()
+        self.history_rain = RainCounter(HISTORY_RAIN_MAX)
         # do not set time when offset to whole hour is <= _a3_offset
         self._a3_offset = 3
 
+        # a response window is missed when the RF thread wakes up late or
+        # takes too long to respond, e.g. while waiting for the GIL.
+        self.window_limit = 0.050 # seconds
+        self.rf_stats = {'frames': 0, 'missed_windows': 0, 'weather_frames': 0,
+                         'max_wakeup_delay': 0.0, 'max_response_time': 0.0}
+
+        # in fast mode ask for current weather in every cycle, but ask for
+        # history now and then to keep track of the latest history index
+        self.fast_current = False
+        self.fast_history_check = 60 # seconds
+        self.comm_controller = None
+
+        self.flash_cache_file = None
+        self.startup_times = dict()
+        self.startup_ts = None
+
+        self.frequency_standard = None
+        self.usb_args = None
+        self.recovery_request = None
+        self.rf_stats['recovery'] = dict()
+        self.frame_recorder = FrameRecorder()
+        self.current_seen = 0  # weather frames seen by waitForCurrentData
+        # notified each time the RF thread has handled a frame
+        self.change_cond = threading.Condition()
+
     def buildFirstConfigFrame(self, Buffer, cs):
         logdbg('buildFirstConfigFrame: cs=%04x' % cs)
         newBuffer = [0]
@@ -3488,7 +5899,6 @@ class CommunicationService(object):
         newBuffer = [0]
         newBuffer[0] = [0]*48
         cfgBuffer = [0]
-        cfgBuffer[0] = [0]*44
         changed = self.station_config.testConfigChanged(cfgBuffer)
         if changed:
             self.hid.dump('OutBuf', cfgBuffer[0], fmt='long')
@@ -3507,7 +5917,7 @@ class CommunicationService(object):
     def buildTimeFrame(self, Buffer, cs):
         logdbg("buildTimeFrame: cs=%04x" % cs)
 
-        now = time.time()
+        now = clock.time()
         tm = time.localtime(now)
 
         newBuffer=[0]
@@ -3545,15 +5955,19 @@ class CommunicationService(object):
         # When last weather is stale, change action to get current weather
         # This is only needed during long periods of history data catchup
         if self.command == ACTION_GET_HISTORY:
-            now = int(time.time())
-            age = now - self.last_stat.last_weather_ts
+            age = self.last_stat.age('weather')
             # Morphing action only with GetHistory requests, 
             # and stale data after a period of twice the CommModeInterval,
             # but not with init GetHistory requests (0xF0)
-            if action == ACTION_GET_HISTORY and age >= (comInt +1) * 2 and newBuffer[0][1] != 0xF0:
+            if action == ACTION_GET_HISTORY and (age is None or age >= (comInt +1) * 2) and newBuffer[0][1] != 0xF0:
                 if DEBUG_COMM > 0:
                     logdbg('buildACKFrame: morphing action from %d to 5 (age=%s)' % (action, age))
                 action = ACTION_GET_CURRENT
+        elif (self.fast_current and action == ACTION_GET_HISTORY and
+              newBuffer[0][1] != 0xF0):
+            age = self.last_stat.age('history')
+            if age is not None and age < self.fast_history_check:
+                action = ACTION_GET_CURRENT
 
         if hidx is None:
             if self.command == ACTION_GET_HISTORY:
@@ -3586,7 +6000,7 @@ class CommunicationService(object):
         newBuffer=[0]
         newBuffer[0] = Buffer[0]
         newLength = [0]
-        now = int(time.time())
+        now = int(clock.time())
         self.station_config.read(Buffer)
         if DEBUG_CONFIG_DATA > 1:
             self.station_config.toLog()
@@ -3605,22 +6019,26 @@ class CommunicationService(object):
         if DEBUG_WEATHER_DATA > 0:
             logdbg('handleCurrentData: %s' % self.timing())
 
-        now = int(time.time())
+        now = int(clock.time())
 
         # update the weather data cache if changed or stale
         chksum = CurrentData.calcChecksum(Buffer)
-        age = now - self.last_stat.last_weather_ts
-        if age >= self.comm_mode_interval:
+        age = self.last_stat.age('weather')
+        if age is None or age >= self.comm_mode_interval or self.fast_current:
             if DEBUG_WEATHER_DATA > 2:
                 self.hid.dump('CurWea', Buffer[0], fmt='long')
             data = CurrentData()
             data.read(Buffer)
             self.current = data
+            self.rf_stats['weather_frames'] += 1
+            if self.comm_controller is not None:
+                self.comm_mode_interval = self.comm_controller.update(
+                    data, clock.monotonic())
             if DEBUG_WEATHER_DATA > 1:
                 data.toLog()
         else:
             if DEBUG_WEATHER_DATA > 1:
-                logdbg('new weather data within %s; skip data; ts=%s' %
+                logdbg('new weather data within %.1f; skip data; ts=%s' %
                        (age, now))
 
         # update the connection cache
@@ -3635,9 +6053,7 @@ class CommunicationService(object):
 
         cs = newBuffer[0][5] | (newBuffer[0][4] << 8)
 
-        cfgBuffer = [0]
-        cfgBuffer[0] = [0]*44
-        changed = self.station_config.testConfigChanged(cfgBuffer)
+        changed = self.station_config.testConfigChanged()
         inBufCS = self.station_config.getInBufCS()
         if inBufCS == 0 or inBufCS != cs:
             # request for a get config
@@ -3665,7 +6081,7 @@ class CommunicationService(object):
         if DEBUG_HISTORY_DATA > 0:
             logdbg('handleHistoryData: %s' % self.timing())
 
-        now = int(time.time())
+        now = int(clock.time())
         self.last_stat.update(seen_ts=now,
                                         quality=(buf[0][3] & 0x7f),
                                         battery=(buf[0][2] & 0xf),
@@ -3707,7 +6123,7 @@ class CommunicationService(object):
                 else:
                     loginf('handleHistoryData: request records since %s' %
                            weeutil.weeutil.timestamp_to_string(self.history_cache.since_ts))
-                    span = int(time.time()) - self.history_cache.since_ts
+                    span = int(clock.time()) - self.history_cache.since_ts
                     # FIXME: what if we do not have config data yet?
                     cfg = self.getConfigData().asDict()
                     arcint = 60 * getHistoryInterval(cfg['history_interval'])
@@ -3733,19 +6149,18 @@ class CommunicationService(object):
                     self.history_cache.num_scanned += 1
                     # get the next history record
                     if ts is not None and self.history_cache.since_ts <= ts:
-                        # Check if two records in a row with the same ts
-                        if self.history_cache.last_ts == ts:
-                            if DEBUG_HISTORY_DATA > 0:
-                                logdbg('handleHistoryData: remove previous record'
-                                   ' with duplicate timestamp: %s' %
-                                   weeutil.weeutil.timestamp_to_string(ts))
-                            self.history_cache.records.pop()
-                        self.history_cache.last_ts = ts
+                        # duplicates and out-of-order records are resolved
+                        # by a HistoryProcessor when the records are used
+                        record = data.asDict()
+                        delta = self.history_rain.update(data.getRainTotal(),
+                                                         ts=ts)
+                        if delta is not None:
+                            record['rain'] = delta / 10  # weewx wants cm
                         # append to the history
                         if DEBUG_HISTORY_DATA > 0:
                             logdbg('handleHistoryData: appending history record'
-                               ' %s: %s' % (thisIndex, data.asDict()))
-                        self.history_cache.records.append(data.asDict())
+                               ' %s: %s' % (thisIndex, record))
+                        self.history_cache.records.append(record)
                         self.history_cache.num_outstanding_records = nrec
                     elif ts is None:
                         logerr('handleHistoryData: skip record: this_ts=None')
@@ -3771,7 +6186,7 @@ class CommunicationService(object):
         newBuffer[0] = Buffer[0]
         newLength = [0]
         newLength[0] = Length[0]
-        self.last_stat.update(seen_ts=int(time.time()),
+        self.last_stat.update(seen_ts=int(clock.time()),
                                         quality=(Buffer[0][3] & 0x7f))
         cs = newBuffer[0][5] | (newBuffer[0][4] << 8)
         if (Buffer[0][2] & 0xEF) == RESPONSE_REQ_FIRST_CONFIG:
@@ -3784,9 +6199,9 @@ class CommunicationService(object):
             newLength[0] = self.buildConfigFrame(newBuffer)
         elif (Buffer[0][2] & 0xEF) == RESPONSE_REQ_SET_TIME:
             logdbg('handleNextAction: a3 (set time data)')
-            now = int(time.time())
-            age = now - self.last_stat.last_weather_ts
-            if age >= (self.comm_mode_interval +1) * 2:
+            now = int(clock.time())
+            age = self.last_stat.age('weather')
+            if age is None or age >= (self.comm_mode_interval +1) * 2:
                 # always set time if init or stale communication
                 self.setSleep(0.085, 0.005)
                 newLength[0] = self.buildTimeFrame(newBuffer, cs)
@@ -3950,13 +6365,7 @@ class CommunicationService(object):
         freq = frequencies.get(frequency_standard, frequencies['EU'])
         loginf('base frequency: %d' % freq)
         freqVal = long(freq / 16000000.0 * 16777216.0)
-        corVec = self.hid.readConfigFlash(0x1F5, 4)
-        corVal = corVec[0] << 8
-        corVal |= corVec[1]
-        corVal <<= 8
-        corVal |= corVec[2]
-        corVal <<= 8
-        corVal |= corVec[3]
+        corVal, buf = self.readFlashValues()
         loginf('frequency correction: %d (0x%x)' % (corVal, corVal))
         freqVal += corVal
         if not (freqVal % 2):
@@ -3973,7 +6382,6 @@ class CommunicationService(object):
             self.reg_names[AX5051RegisterNames.FREQ0]))
 
         # figure out the transceiver id
-        buf = self.hid.readConfigFlash(0x1F9, 7)
         tid = (buf[5] << 8) + buf[6]
         loginf('transceiver identifier: %d (0x%04x)' % (tid, tid))
         self.transceiver_settings.device_id = tid
@@ -3986,13 +6394,81 @@ class CommunicationService(object):
         for r in self.reg_names:
             self.hid.writeReg(r, self.reg_names[r])
 
+    def readFlashValues(self):
+        """Return the frequency correction and the transceiver identifier
+        bytes from the transceiver flash.  They never change for a given
+        transceiver, so if there is a flash cache file they are saved there
+        by serial number and read from the file next time."""
+        cache = dict()
+        if self.flash_cache_file is not None:
+            try:
+                f = open(self.flash_cache_file)
+                try:
+                    cache = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError), e:
+                logdbg('cannot read flash cache %s: %s' %
+                       (self.flash_cache_file, e))
+        buf = None
+        sn = self.config_serial
+        if sn is None or str(sn) not in cache:
+            buf = self.hid.readConfigFlash(0x1F9, 7)
+            sn = ''.join(['%02d' % x for x in buf[0:7]])
+        entry = cache.get(str(sn))
+        if entry is not None:
+            logdbg('using cached flash values for %s' % sn)
+            return entry['correction'], buf or entry['id']
+        if buf is None:
+            buf = self.hid.readConfigFlash(0x1F9, 7)
+        corVec = self.hid.readConfigFlash(0x1F5, 4)
+        corVal = corVec[0] << 8
+        corVal |= corVec[1]
+        corVal <<= 8
+        corVal |= corVec[2]
+        corVal <<= 8
+        corVal |= corVec[3]
+        if self.flash_cache_file is not None:
+            cache[str(sn)] = {'correction': corVal, 'id': list(buf[0:7])}
+            try:
+                f = open(self.flash_cache_file, 'w')
+                try:
+                    json.dump(cache, f)
+                finally:
+                    f.close()
+            except IOError, e:
+                logerr('cannot save flash cache %s: %s' %
+                       (self.flash_cache_file, e))
+        return corVal, buf
+
     def setup(self, frequency_standard, comm_interval,
-              vendor_id, product_id, serial):
+              vendor_id, product_id, serial, fast_current=False,
+              comm_controller=None, flash_cache_file=None,
+              usb_retries=3, usb_reconnect_timeout=60, frame_recorder=None):
+        self.startup_ts = clock.monotonic()
+        self.flash_cache_file = flash_cache_file
+        if frame_recorder is not None:
+            self.frame_recorder = frame_recorder
+        self.hid.retries = usb_retries
+        self.hid.reconnect_timeout = usb_reconnect_timeout
         loginf("comm_interval is %s" % comm_interval)
         self.comm_mode_interval = comm_interval
+        self.comm_controller = comm_controller
+        if comm_controller is not None:
+            self.comm_mode_interval = comm_controller.interval
+            loginf('adaptive comm_interval: %s' % comm_controller)
+        self.fast_current = fast_current
+        if fast_current:
+            loginf('fast current weather mode')
         self.config_serial = serial  # the serial number given in weewx.conf
+        self.frequency_standard = frequency_standard
+        self.usb_args = (vendor_id, product_id, serial)
+        t0 = clock.monotonic()
         self.hid.open(vendor_id, product_id, serial)
+        t1 = clock.monotonic()
         self.initTransceiver(frequency_standard)
+        self.startup_times['usb_open'] = t1 - t0
+        self.startup_times['init'] = clock.monotonic() - t1
         self.transceiver_present = True
 
     def teardown(self):
@@ -4022,6 +6498,8 @@ class CommunicationService(object):
 
     # FIXME: make this thread-safe
     def getCurrentData(self):
+        if self.error is not None:
+            raise weewx.WeeWxIOError('RF thread failed: %s' % self.error)
         return self.current
 
     # FIXME: make this thread-safe
@@ -4060,6 +6538,47 @@ class CommunicationService(object):
     def getHistoryCacheRecords(self):
         return self.history_cache.records
 
+    def getRFStats(self):
+        stats = dict(self.rf_stats)
+        stats['startup_times'] = dict(self.startup_times)
+        stats['recovery'] = dict([(k, dict(v)) for k, v in
+                                  self.rf_stats['recovery'].items()])
+        stats['usb'] = self.hid.getStats()
+        stats['frame_dumps'] = self.frame_recorder.num_dumps
+        return stats
+
+    def notifyChange(self):
+        self.change_cond.acquire()
+        try:
+            self.change_cond.notifyAll()
+        finally:
+            self.change_cond.release()
+
+    def waitForChange(self, predicate, timeout):
+        """Wait until predicate() is true, at most timeout seconds.  The
+        predicate is checked again each time the RF thread has handled a
+        frame, so this returns as soon as the console responds."""
+        end = clock.monotonic() + timeout
+        self.change_cond.acquire()
+        try:
+            while not predicate():
+                remaining = end - clock.monotonic()
+                if remaining <= 0:
+                    return False
+                self.change_cond.wait(remaining)
+            return True
+        finally:
+            self.change_cond.release()
+
+    def waitForCurrentData(self, timeout):
+        """Wait for current weather data that arrived since the previous
+        call, at most timeout seconds."""
+        arrived = self.waitForChange(
+            lambda: self.rf_stats['weather_frames'] != self.current_seen,
+            timeout)
+        self.current_seen = self.rf_stats['weather_frames']
+        return arrived
+
     def clearHistoryCache(self):
         self.history_cache.clear_records()
 
@@ -4085,6 +6604,7 @@ class CommunicationService(object):
                    self.thread_wait)
         else:
             self.child = None
+        loginf('rf statistics: %s' % self.rf_stats)
 
     def isRunning(self):
         return self.running
@@ -4097,12 +6617,39 @@ class CommunicationService(object):
             while self.history_cache.wait_at_start == 1:
                 time.sleep(1)
             logdbg("starting rf communication; press SET button shortly if communication won't start")
+            t0 = clock.monotonic()
             while self.running:
-                self.doRFCommunication()
+                if self.recovery_request is not None:
+                    self.doRecovery(self.recovery_request)
+                    self.recovery_request = None
+                try:
+                    self.doRFCommunication()
+                    self.usb_failures = 0
+                except usb.USBError, e:
+                    # the transport already retried, so the transceiver
+                    # is either gone or stuck.
+                    logerr('rf communication failed: %s' % e)
+                    self.dumpFrames('USB error: %s' % e)
+                    self.usb_failures += 1
+                    if self.usb_failures > self.max_usb_failures:
+                        raise weewx.WeeWxIOError(
+                            'rf communication failed after reopening the'
+                            ' transceiver %d times: %s' %
+                            (self.max_usb_failures, e))
+                    self.doRecovery('reopen')
+                self.notifyChange()
+                if self.startup_ts is not None and self.rf_stats['frames']:
+                    self.startup_times['first_frame'] = clock.monotonic() - t0
+                    self.startup_times['total'] = clock.monotonic() - self.startup_ts
+                    self.startup_ts = None
+                    loginf('startup times: %s' %
+                           ', '.join(['%s=%.2fs' % (k, v) for k, v in
+                                      sorted(self.startup_times.items())]))
         except Exception, e:
             logerr('exception in doRF: %s' % e)
             if weewx.debug:
                 log_traceback(dst=syslog.LOG_DEBUG)
+            self.error = str(e)
             self.running = False
             raise
         finally:
@@ -4113,29 +6660,67 @@ class CommunicationService(object):
     # doing it this way makes configuration easier during a factory reset and
     # when re-establishing communication with the station sensors.
     def doRFSetup(self):
+        t0 = clock.monotonic()
         self.hid.execute(5)
         self.hid.setPreamblePattern(0xaa)
         self.hid.setState(0)
-        time.sleep(1)
+        self.hid.waitForState()
         self.hid.setRX()
 
         self.hid.setPreamblePattern(0xaa)
         self.hid.setState(0x1e)
-        time.sleep(1)
+        self.hid.waitForState()
         self.hid.setRX()
         self.setSleep(0.085, 0.005)
+        if self.startup_ts is not None:
+            self.startup_times['rf_setup'] = clock.monotonic() - t0
+
+    def requestRecovery(self, tier):
+        """Ask the RF thread to recover communication.  tier is one of
+        RECOVERY_TIERS."""
+        self.recovery_request = tier
+
+    def dumpFrames(self, reason):
+        self.frame_recorder.dump(reason)
+
+    def doRecovery(self, tier):
+        """Recover communication with the transceiver:
+          rx     - send the preamble pattern and enter receive mode again
+          reset  - reset the transceiver state, as at startup
+          reopen - close the USB device, find it again on the bus and
+                   open it, then initialize the transceiver as at startup"""
+        loginf('recovery: %s' % tier)
+        t0 = clock.monotonic()
+        failed = False
+        try:
+            if tier == 'rx':
+                self.hid.setPreamblePattern(0xaa)
+                self.hid.setRX()
+            elif tier == 'reset':
+                self.doRFSetup()
+            elif tier == 'reopen':
+                self.hid.reconnect()
+                self.initTransceiver(self.frequency_standard)
+                self.doRFSetup()
+        except (usb.USBError, weewx.WeeWxIOError), e:
+            logerr('recovery %s failed: %s' % (tier, e))
+            failed = True
+        dur = clock.monotonic() - t0
+        stats = self.rf_stats['recovery'].setdefault(
+            tier, {'attempts': 0, 'failures': 0, 'time': 0.0})
+        stats['attempts'] += 1
+        stats['time'] += dur
+        if failed:
+            stats['failures'] += 1
+        logdbg('recovery %s took %.2f s' % (tier, dur))
 
     def doRFCommunication(self):
+        t0 = clock.monotonic()
         time.sleep(self.firstSleep)
+        wakeup_delay = clock.monotonic() - t0 - self.firstSleep
         self.pollCount = 0
-        while self.running:
-            statebuf = [0] * 2
-            try:
-                statebuf = self.hid.getState()
-            except Exception, e:
-                logerr('getState failed: %s' % e)
-                time.sleep(5)
-                pass
+        while self.running and self.recovery_request is None:
+            statebuf = self.hid.getState()
             self.pollCount += 1
             if statebuf[0] == 0x16:
                 break
@@ -4147,22 +6732,47 @@ class CommunicationService(object):
         DataLength[0] = 0
         FrameBuffer=[0]
         FrameBuffer[0]=[0]*0x03
+        rx_ts = clock.monotonic()
         self.hid.getFrame(FrameBuffer, DataLength)
+        entry = self.frame_recorder.record('rx', FrameBuffer[0], DataLength[0])
         try:
             self.generateResponse(FrameBuffer, DataLength)
             self.hid.setFrame(FrameBuffer[0], DataLength[0])
             self.hid.setTX()
+            self.updateRFStats(wakeup_delay, clock.monotonic() - rx_ts)
+            entry[3] = 'ok'
+            self.frame_recorder.record('tx', FrameBuffer[0], DataLength[0],
+                                       'sent')
         except DataWritten, e:
             logdbg('SetTime/SetConfig data written')
+            entry[3] = 'data-written'
             self.hid.setRX()
         except BadResponse, e:
             logerr('generateResponse failed: %s' % e)
+            entry[3] = 'bad-response'
+            self.dumpFrames('bad response: %s' % e)
             self.hid.setRX()
         except UnknownDeviceId, e:
             if self.config_serial is None:
                 logerr("%s; use parameter 'serial' if more than one USB transceiver present" % e)
+            entry[3] = 'unknown-device-id'
+            self.dumpFrames('unknown device id: %s' % e)
             self.hid.setRX()
 
+    def updateRFStats(self, wakeup_delay, response_time):
+        stats = self.rf_stats
+        stats['frames'] += 1
+        if (wakeup_delay > self.window_limit or
+            response_time > self.window_limit):
+            stats['missed_windows'] += 1
+            if DEBUG_COMM > 0:
+                logdbg('missed response window: wakeup_delay=%.3f'
+                       ' response_time=%.3f' % (wakeup_delay, response_time))
+        if wakeup_delay > stats['max_wakeup_delay']:
+            stats['max_wakeup_delay'] = wakeup_delay
+        if response_time > stats['max_response_time']:
+            stats['max_response_time'] = response_time
+
     # these are for diagnostics and debugging
     def setSleep(self, firstsleep, nextsleep):
         self.firstSleep = firstsleep
@@ -4172,3 +6782,664 @@ class CommunicationService(object):
         s = self.firstSleep + self.nextSleep * (self.pollCount - 1)
         return 'sleep=%s first=%s next=%s count=%s' % (
             s, self.firstSleep, self.nextSleep, self.pollCount)
+
+
+class SharedRing(object):
+    """Ring buffer of messages in shared memory, with one process writing
+    and one process reading.  Each message is a pickled object preceded by
+    its length.
+
+    The positions of the writer (head) and the reader (tail) are 32-bit
+    counters in shared memory, so that they can be stored in one access on
+    32-bit processors too, and they are only read and changed while
+    holding lock, which also orders the copying of the messages with
+    respect to the change of the positions.  The writer never overwrites
+    messages that have not been read; if there is no room, the message is
+    dropped and counted as an overrun.  The size must be a power of 2 so
+    that positions stay consistent when the counters wrap around.
+
+    get must not be called by more than one thread at a time."""
+
+    MASK = 0xffffffff
+
+    def __init__(self, size=1 << 20):
+        if size & (size - 1):
+            raise ValueError('SharedRing size must be a power of 2')
+        self.size = size
+        self.buf = multiprocessing.RawArray(ctypes.c_char, size)
+        self.lock = multiprocessing.Lock()
+        self.head = multiprocessing.RawValue(ctypes.c_uint32, 0)
+        self.tail = multiprocessing.RawValue(ctypes.c_uint32, 0)
+        self._overruns = multiprocessing.RawValue(ctypes.c_uint32, 0)
+
+    @property
+    def overruns(self):
+        return int(self._overruns.value)
+
+    def _write(self, pos, data):
+        i = pos % self.size
+        n = min(len(data), self.size - i)
+        self.buf[i:i + n] = data[:n]
+        if n < len(data):
+            self.buf[0:len(data) - n] = data[n:]
+
+    def _read(self, pos, nbytes):
+        i = pos % self.size
+        n = min(nbytes, self.size - i)
+        data = self.buf[i:i + n]
+        if n < nbytes:
+            data += self.buf[0:nbytes - n]
+        return data
+
+    def put(self, obj):
+        """Append a message.  Return False if there was no room for it."""
+        data = cPickle.dumps(obj, 2)
+        data = struct.pack('<I', len(data)) + data
+        if len(data) > self.size / 2:
+            logerr('SharedRing: message of %d bytes is too big' % len(data))
+            return False
+        with self.lock:
+            head = self.head.value
+            used = (head - self.tail.value) & self.MASK
+            if used + len(data) > self.size:
+                self._overruns.value += 1
+                return False
+        # the reader does not look beyond head, so this can be done
+        # without the lock
+        self._write(head, data)
+        with self.lock:
+            self.head.value = (head + len(data)) & self.MASK
+        return True
+
+    def get(self):
+        """Return a list of the messages since the last call."""
+        with self.lock:
+            head = self.head.value
+            tail = self.tail.value
+        msgs = []
+        while tail != head:
+            (n,) = struct.unpack('<I', self._read(tail, 4))
+            msgs.append(cPickle.loads(self._read(tail + 4, n)))
+            tail = (tail + 4 + n) & self.MASK
+        with self.lock:
+            self.tail.value = tail
+        return msgs
+
+
+def set_realtime(priority=None, cpus=None):
+    """Use the SCHED_FIFO scheduler with the indicated priority and run only
+    on the indicated cpus, for the calling process.  This works only on
+    linux, and requires the appropriate privileges."""
+    if priority is None and not cpus:
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if cpus:
+        mask = 0
+        for c in cpus:
+            mask |= 1 << c
+        cmask = ctypes.c_ulong(mask)
+        if libc.sched_setaffinity(0, ctypes.sizeof(cmask),
+                                  ctypes.byref(cmask)) != 0:
+            logerr('cannot set cpu affinity to %s: %s' %
+                   (cpus, os.strerror(ctypes.get_errno())))
+        else:
+            loginf('rf process cpu affinity is %s' % cpus)
+    if priority is not None:
+        SCHED_FIFO = 1
+        param = ctypes.c_int(priority)
+        if libc.sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)) != 0:
+            logerr('cannot set SCHED_FIFO priority %s: %s' %
+                   (priority, os.strerror(ctypes.get_errno())))
+        else:
+            loginf('rf process uses SCHED_FIFO priority %s' % priority)
+
+
+def rf_process_main(ring, conn, first_sleep, setup_args, rain_state,
+                    priority, cpus):
+    """Run a CommunicationService in a child process.  Apply the commands
+    that arrive on conn and publish the state of the service to ring."""
+    svc = CommunicationService(first_sleep)
+    svc.history_rain.from_dict(rain_state)
+    seq = 0  # the last command that was applied
+    profiler = None
+    try:
+        set_realtime(priority, cpus)
+        svc.setup(*setup_args)
+        svc.startRFThread()
+        last_ts = last_cs = last_stat = None
+        nrec = 0
+        while svc.isRunning():
+            if conn.poll(0.1):
+                cmd = conn.recv()
+                seq = cmd[0]
+                if cmd[1] == 'stop':
+                    break
+                elif cmd[1] == 'start_history':
+                    svc.startCachingHistory(cmd[2], cmd[3])
+                    nrec = 0
+                elif cmd[1] == 'stop_history':
+                    svc.stopCachingHistory()
+                elif cmd[1] == 'clear_history':
+                    svc.clearHistoryCache()
+                    nrec = 0
+                elif cmd[1] == 'clear_wait':
+                    svc.clearWaitAtStart()
+                elif cmd[1] == 'recover':
+                    svc.requestRecovery(cmd[2])
+                elif cmd[1] == 'dump_frames':
+                    svc.dumpFrames(cmd[2])
+                elif cmd[1] == 'profile':
+                    if profiler is None or not profiler.running:
+                        profiler = SamplingProfiler(['RFComm'], *cmd[2:])
+                    ring.put(('profile', seq, profiler.start()))
+            # if the ring is full, try again next time
+            data = svc.getCurrentData()
+            if data._timestamp != last_ts:
+                if ring.put(('current', data)):
+                    last_ts = data._timestamp
+            cfg = svc.getConfigData()
+            if (cfg._InBufCS, cfg._OutBufCS) != last_cs:
+                if ring.put(('config', cfg)):
+                    last_cs = (cfg._InBufCS, cfg._OutBufCS)
+            records = svc.getHistoryCacheRecords()
+            while nrec < len(records):
+                if not ring.put(('history', seq, records[nrec])):
+                    break
+                nrec += 1
+            cache = svc.history_cache
+            stat = {'seq': seq,
+                    'last_stat': dict(svc.getLastStat().__dict__),
+                    'present': svc.getTransceiverPresent(),
+                    'registered_device_id': svc.registered_device_id,
+                    'device_id': svc.getDeviceID(),
+                    'serial': svc.getTransceiverSerNo(),
+                    'num_outstanding_records': cache.num_outstanding_records,
+                    'next_index': cache.next_index,
+                    'num_scanned': cache.num_scanned,
+                    'history_rain': svc.history_rain.to_dict(),
+                    'rf_stats': svc.getRFStats()}
+            if stat != last_stat:
+                if ring.put(('stat', stat)):
+                    last_stat = stat
+    except Exception, e:
+        logerr('exception in rf process: %s' % e)
+        ring.put(('error', str(e)))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if svc.child is not None:
+            svc.stopRFThread()
+        svc.teardown()
+
+
+class RFProcess(object):
+    """Run the CommunicationService in a child process, so that the RF
+    communication does not compete for the GIL with the rest of weewx.
+    This provides the methods of CommunicationService that the driver
+    uses, based on the state that the child process publishes."""
+
+    def __init__(self, first_sleep, priority=None, cpus=None):
+        self.first_sleep = first_sleep
+        self.priority = priority
+        self.cpus = cpus
+        self.thread_wait = 60.0 # seconds
+        self.ring = None
+        self.conn = None
+        self.child = None
+        self.setup_args = None
+        self.error = None
+        self.seq = 0
+        self.stat = {}
+        self.current = CurrentData()
+        self.last_stat = LastStat()
+        self.station_config = StationConfig()
+        self.history_rain = RainCounter(HISTORY_RAIN_MAX)
+        self.records = []
+        self.history_seq = 0  # ignore history state from before this command
+        self.current_count = 0
+        self.current_seen = 0
+        self.profile = (0, None)  # command sequence and profile file name
+        # the driver thread and the control socket thread both update
+        self.lock = threading.RLock()
+
+    def setup(self, frequency_standard, comm_interval,
+              vendor_id, product_id, serial, fast_current=False,
+              comm_controller=None, flash_cache_file=None,
+              usb_retries=3, usb_reconnect_timeout=60, frame_recorder=None):
+        self.setup_args = (frequency_standard, comm_interval,
+                           vendor_id, product_id, serial, fast_current,
+                           comm_controller, flash_cache_file,
+                           usb_retries, usb_reconnect_timeout,
+                           frame_recorder)
+
+    def teardown(self):
+        pass
+
+    def startRFThread(self):
+        if self.child is not None:
+            return
+        logdbg('startRFThread: spawning RF process')
+        self.ring = SharedRing()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.child = multiprocessing.Process(
+            target=rf_process_main, name='RFComm',
+            args=(self.ring, child_conn, self.first_sleep, self.setup_args,
+                  self.history_rain.to_dict(), self.priority, self.cpus))
+        self.child.daemon = True
+        self.child.start()
+
+    def stopRFThread(self):
+        if self.child is None:
+            return
+        logdbg('stopRFThread: waiting for RF process to terminate')
+        try:
+            self.command('stop')
+        except (IOError, EOFError):
+            pass
+        self.child.join(self.thread_wait)
+        if self.child.is_alive():
+            logerr('unable to terminate RF process after %d seconds' %
+                   self.thread_wait)
+            self.child.terminate()
+        self.child = None
+        try:
+            self.update()
+        except weewx.WeeWxIOError:
+            pass
+        loginf('rf statistics: %s' % self.getRFStats())
+
+    def command(self, *args):
+        with self.lock:
+            self.seq += 1
+            self.conn.send((self.seq,) + args)
+            return self.seq
+
+    def update(self):
+        """Apply the messages from the child process."""
+        with self.lock:
+            self._update()
+
+    def _update(self):
+        for msg in self.ring.get():
+            if msg[0] == 'current':
+                self.current = msg[1]
+                self.current_count += 1
+            elif msg[0] == 'config':
+                self.station_config = msg[1]
+            elif msg[0] == 'history':
+                if msg[1] >= self.history_seq:
+                    self.records.append(msg[2])
+            elif msg[0] == 'stat':
+                self.stat = msg[1]
+                self.last_stat.__dict__.update(msg[1]['last_stat'])
+                self.history_rain.from_dict(msg[1]['history_rain'])
+            elif msg[0] == 'profile':
+                self.profile = (msg[1], msg[2])
+            elif msg[0] == 'error':
+                self.error = msg[1]
+        if self.error is not None:
+            raise weewx.WeeWxIOError('RF process failed: %s' % self.error)
+        if self.child is not None and not self.child.is_alive():
+            raise weewx.WeeWxIOError('RF process terminated')
+
+    def get_cache_stat(self, name, default=None):
+        self.update()
+        if self.stat.get('seq', 0) < self.history_seq:
+            return default
+        return self.stat.get(name, default)
+
+    def getTransceiverPresent(self):
+        self.update()
+        return self.stat.get('present', False)
+
+    def getDeviceRegistered(self):
+        self.update()
+        device_id = self.stat.get('device_id')
+        return (device_id is not None and
+                self.stat.get('registered_device_id') == device_id)
+
+    def getDeviceID(self):
+        self.update()
+        return self.stat.get('device_id')
+
+    def getTransceiverSerNo(self):
+        self.update()
+        return self.stat.get('serial')
+
+    def getCurrentData(self):
+        self.update()
+        return self.current
+
+    def getLastStat(self):
+        self.update()
+        return self.last_stat
+
+    def waitForCurrentData(self, timeout):
+        end = clock.monotonic() + timeout
+        while True:
+            self.update()
+            if self.current_count != self.current_seen:
+                self.current_seen = self.current_count
+                return True
+            if clock.monotonic() >= end:
+                return False
+            time.sleep(0.05)
+
+    def waitForChange(self, predicate, timeout):
+        end = clock.monotonic() + timeout
+        while not predicate():
+            if clock.monotonic() >= end:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def getConfigData(self):
+        self.update()
+        return self.station_config
+
+    def getRFStats(self):
+        stats = dict(self.stat.get('rf_stats', {}))
+        if self.ring is not None:
+            stats['ring_overruns'] = self.ring.overruns
+        return stats
+
+    def startCachingHistory(self, since_ts=0, num_rec=0):
+        self.records = []
+        self.history_seq = self.command('start_history', since_ts, num_rec)
+
+    def stopCachingHistory(self):
+        self.command('stop_history')
+
+    def getUncachedHistoryCount(self):
+        return self.get_cache_stat('num_outstanding_records')
+
+    def getNextHistoryIndex(self):
+        return self.get_cache_stat('next_index')
+
+    def getNumHistoryScanned(self):
+        return self.get_cache_stat('num_scanned', 0)
+
+    def getLatestHistoryIndex(self):
+        self.update()
+        return self.last_stat.latest_history_index
+
+    def getHistoryCacheRecords(self):
+        self.update()
+        return self.records
+
+    def clearHistoryCache(self):
+        self.records = []
+        self.history_seq = self.command('clear_history')
+
+    def clearWaitAtStart(self):
+        self.command('clear_wait')
+
+    def requestRecovery(self, tier):
+        self.command('recover', tier)
+
+    def dumpFrames(self, reason):
+        self.command('dump_frames', reason)
+
+    def startProfile(self, duration, interval, dump_dir, fmt, timeout=5):
+        """Start profiling the RF thread in the child process.  Return the
+        name of the file it will write, or None if the child does not
+        answer within timeout seconds."""
+        seq = self.command('profile', duration, interval, dump_dir, fmt)
+        end = clock.monotonic() + timeout
+        while clock.monotonic() < end:
+            self.update()
+            if self.profile[0] >= seq:
+                return self.profile[1]
+            time.sleep(0.05)
+        logerr('rf process did not start profiling')
+        return None
+
+
+# define a main entry point for basic testing of the driver without weewx
+# engine and service overhead.  invoke this as follows from the weewx root dir:
+#
+# PYTHONPATH=bin python bin/weewx/drivers/ws28xx.py
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = """%prog [options] [--help]"""
+
+    # current weather frame from the 'Examples of messages' section above
+    SAMPLE_CURRENT_FRAME = [int(x, 16) for x in """
+        01 2e 60 5f 05 1b 00 00 12 01 30 62 21 54 41 30 62 40 75 36
+        59 00 60 70 06 35 00 01 30 62 31 61 21 30 62 30 55 95 92 00
+        53 10 05 37 00 01 30 62 01 90 81 30 62 40 90 66 38 00 49 00
+        05 37 00 01 30 62 21 53 01 30 62 22 31 75 51 11 50 40 05 13
+        80 13 06 22 21 40 13 06 23 19 37 67 52 59 13 06 23 06 09 13
+        06 23 16 19 91 65 86 00 00 00 00 00 00 00 00 00 00 00 00 00
+        00 00 00 00 00 00 00 00 00 13 06 23 09 59 00 06 19 00 00 51
+        13 06 22 20 43 00 01 54 00 00 00 01 30 62 21 51 00 00 38 70
+        a7 cc 7b 50 09 01 01 00 00 00 00 00 00 fc 00 a7 cc 7b 14 13
+        06 23 14 06 0e a0 00 01 b0 00 13 06 23 06 34 03 00 91 01 92
+        03 00 91 01 92 02 97 41 00 74 03 00 91 01 92""".split()]
+
+    # history frame from the 'Examples of messages' section above
+    SAMPLE_HISTORY_FRAME = [int(x, 16) for x in """
+        01 2e 80 5f 05 1b 00 7b 32 00 7b 32 00 0c 70 0a 00 08 65 91
+        01 92 53 76 35 13 06 24 09 10""".split()]
+
+    def timeit(label, func, count, unit='packet'):
+        t0 = time.time()
+        for _ in xrange(count):
+            func()
+        dt = time.time() - t0
+        print '%-32s %10.1f us/%s' % (label, 1000000.0 * dt / count, unit)
+        return dt
+
+    def bench(count):
+        data = CurrentData()
+        buf = [SAMPLE_CURRENT_FRAME + [0] * (0x131 - len(SAMPLE_CURRENT_FRAME))]
+
+        def legacy_sentinels():
+            # per-field trait lookups as done prior to OBSERVATION_SENTINELS
+            T = CWeatherTraits
+            get_datum_diff(data._TempIndoor,
+                           T.TemperatureNP(), T.TemperatureOFL())
+            get_datum_diff(data._HumidityIndoor,
+                           T.HumidityNP(), T.HumidityOFL())
+            get_datum_diff(data._TempOutdoor,
+                           T.TemperatureNP(), T.TemperatureOFL())
+            get_datum_diff(data._HumidityOutdoor,
+                           T.HumidityNP(), T.HumidityOFL())
+            get_datum_diff(data._PressureRelative_hPa,
+                           T.PressureNP(), T.PressureOFL())
+            get_datum_diff(data._WindSpeed, T.WindNP(), T.WindOFL())
+            get_datum_diff(data._Gust, T.WindNP(), T.WindOFL())
+            get_datum_match(data._Rain1H, T.RainNP(), T.RainOFL())
+            get_datum_match(data._RainTotal, T.RainNP(), T.RainOFL())
+
+        print 'iterations: %d' % count
+        timeit('CurrentData.read', lambda: data.read(buf), count)
+        a = timeit('sentinels (per-field traits)', legacy_sentinels, count)
+        b = timeit('sentinels (single pass)',
+                   lambda: get_valid_observations(data), count)
+        print 'sentinel check speedup: %.1fx' % (a / b if b else 0)
+
+        data.read(buf)
+        wdirs = [data._WindDirection, data._WindDirection1,
+                 data._WindDirection2, data._WindDirection3,
+                 data._WindDirection4, data._WindDirection5]
+        gdirs = [data._GustDirection, data._GustDirection1,
+                 data._GustDirection2, data._GustDirection3,
+                 data._GustDirection4, data._GustDirection5]
+        speeds = [data._WindSpeed] * 6 + [data._Gust] * 6
+
+        def legacy_conversions():
+            # per-value arithmetic as done prior to the lookup tables
+            p = dict()
+            for name, wdir, v in zip(WIND_DIR_FIELDS, wdirs + gdirs, speeds):
+                if v is None or v == 0 or wdir < 0 or wdir >= 16:
+                    p[name] = None
+                else:
+                    p[name] = wdir * 360 / 16
+            for name, flag in BATTERY_FIELDS:
+                p[name] = 1 if BitHandling.testBit(
+                    5, batterybits.get(flag)) else 0
+            return p
+
+        def table_conversions():
+            p = dict(zip(WIND_DIR_FIELDS, getWindDirs(wdirs + gdirs, speeds)))
+            p.update(BATTERY_PACKET_FIELDS[5])
+            return p
+
+        a = timeit('conversions (per value)', legacy_conversions, count)
+        b = timeit('conversions (tables, bulk)', table_conversions, count)
+        print 'conversion speedup: %.1fx' % (a / b if b else 0)
+
+        data._timestamp = int(time.time())
+        hardware_sentinels = OBSERVATION_SENTINELS + [
+            (attr, np, ofl, fuzzy)
+            for (_, attr, np, ofl, fuzzy, _) in HARDWARE_LOOP_FIELDS]
+
+        def legacy_packet(hardware_derived):
+            # key by key, as get_observation did prior to PacketBuilder,
+            # without the link quality, wind average and rain delta that
+            # get_observation still adds to the built packet
+            packet = {}
+            packet['usUnits'] = weewx.METRIC
+            packet['dateTime'] = data._timestamp
+            if hardware_derived:
+                obs = get_valid_observations(data, hardware_sentinels)
+            else:
+                obs = get_valid_observations(data)
+            packet['inTemp'] = obs['_TempIndoor']
+            packet['inHumidity'] = obs['_HumidityIndoor']
+            packet['outTemp'] = obs['_TempOutdoor']
+            packet['outHumidity'] = obs['_HumidityOutdoor']
+            packet['pressure'] = obs['_PressureRelative_hPa']
+            packet['windSpeed'] = obs['_WindSpeed']
+            packet['windGust'] = obs['_Gust']
+            if hardware_derived:
+                packet['dewpoint'] = obs['_Dewpoint']
+                packet['windchill'] = obs['_Windchill']
+                packet['barometer'] = obs['_PressureRelative_hPa']
+            wdirs = [data._WindDirection, data._WindDirection1,
+                     data._WindDirection2, data._WindDirection3,
+                     data._WindDirection4, data._WindDirection5]
+            gdirs = [data._GustDirection, data._GustDirection1,
+                     data._GustDirection2, data._GustDirection3,
+                     data._GustDirection4, data._GustDirection5]
+            degrees = getWindDirs(wdirs + gdirs,
+                                  [packet['windSpeed']] + [True] * 5 +
+                                  [packet['windGust']] + [True] * 5)
+            packet.update(zip(WIND_DIR_FIELDS, degrees))
+            packet['rainRate'] = obs['_Rain1H']
+            if packet['rainRate'] is not None:
+                packet['rainRate'] /= 10
+            packet.update(BATTERY_PACKET_FIELDS[5])
+            return packet, obs['_RainTotal']
+
+        for hardware_derived in [False, True]:
+            builder = PacketBuilder(hardware_derived)
+            if legacy_packet(hardware_derived) != builder.build(data, 5):
+                print 'packets differ'
+            mode = 'hardware' if hardware_derived else 'software'
+            a = timeit('packet (key by key, %s)' % mode,
+                       lambda: legacy_packet(hardware_derived), count)
+            b = timeit('packet (PacketBuilder, %s)' % mode,
+                       lambda: builder.build(data, 5), count)
+            print 'packets/s: %.0f key by key, %.0f PacketBuilder' % (
+                count / a if a else 0, count / b if b else 0)
+
+        frames = [SAMPLE_HISTORY_FRAME] * WS28xxDriver.max_records
+        def per_record():
+            for f in frames:
+                h = HistoryData()
+                h.read([f])
+                h.asDict()
+        n = max(1, count // 1000)
+        print 'history dump of %d records, %d iterations' % (len(frames), n)
+        timeit('history (per record)', per_record, n, 'dump')
+
+        packet = dict([(x, 1.0) for x in PUBLISHED_FIELDS])
+        fn = os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                          'ws28xx-bench-%d.shm' % os.getpid())
+        publisher = ObservationPublisher(fn)
+        reader = ObservationReader(fn)
+        try:
+            timeit('shm publish', lambda: publisher.publish(packet, LastStat()),
+                   count)
+            timeit('shm read', reader.read, count, 'read')
+        finally:
+            reader.close()
+            publisher.close()
+            os.unlink(fn)
+
+    def listen(address, count):
+        """Receive multicast observations, then report the rate, loss and
+        latency.  The latency is meaningful only when the sender is on the
+        same computer."""
+        listener = MulticastListener(address)
+        print 'listening on %s' % address
+        latency = []
+        start = now = None
+        try:
+            while count == 0 or listener.received < count:
+                msg = listener.recv(timeout=10)
+                if msg is None:
+                    break
+                now = time.time()
+                if start is None:
+                    start = now
+                latency.append(now - msg[1])
+        except KeyboardInterrupt:
+            pass
+        listener.close()
+        print 'received %d, lost %d, reordered %d, sender restarts %d' % (
+            listener.received, listener.lost, listener.reordered,
+            listener.restarts)
+        if len(latency) > 1 and now > start:
+            print 'rate %.1f packets/s' % ((len(latency) - 1) / (now - start))
+            latency.sort()
+            print 'latency median %.1f us, max %.1f us' % (
+                latency[len(latency) // 2] * 1e6, latency[-1] * 1e6)
+
+    def send(address, count, fmt):
+        """Send synthetic observations, for testing a listener."""
+        publisher = MulticastPublisher(address, fmt=fmt, ttl=0)
+        packet = dict([(x, 1.0) for x in PUBLISHED_FIELDS])
+        for i in xrange(count):
+            packet['dateTime'] = time.time()
+            publisher.publish(packet)
+        publisher.close()
+        print 'sent %d packets to %s' % (count, address)
+
+    def main():
+        syslog.openlog('ws28xx', syslog.LOG_PID | syslog.LOG_CONS)
+        parser = optparse.OptionParser(usage=usage)
+        parser.add_option('--version', dest='version', action='store_true',
+                          help='display driver version')
+        parser.add_option('--bench', dest='bench', action='store_true',
+                          help='measure decoding cost using a sample frame')
+        parser.add_option('--count', dest='count', type=int, default=10000,
+                          metavar='N', help='number of benchmark iterations')
+        parser.add_option('--listen', dest='listen', metavar='GROUP:PORT',
+                          help='receive multicast observations, then report'
+                          ' rate, loss and latency; --count 0 for no limit')
+        parser.add_option('--send', dest='send', metavar='GROUP:PORT',
+                          help='send --count synthetic multicast observations')
+        parser.add_option('--format', dest='format', default='json',
+                          type='choice', choices=['json', 'binary'],
+                          help='format for --send, either json or binary')
+        (options, _) = parser.parse_args()
+
+        if options.version:
+            print "ws28xx driver version %s" % DRIVER_VERSION
+            exit(0)
+
+        if options.bench:
+            bench(options.count)
+
+        if options.listen:
+            listen(options.listen, options.count)
+
+        if options.send:
+            send(options.send, options.count, options.format)
+
+    main()